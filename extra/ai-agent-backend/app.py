@@ -1,12 +1,14 @@
 import os
 import awsgi
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from dotenv import load_dotenv
 from services.openai_client import OpenAIClient
 from services.classifier import IntentClassifier
 from services.generic_qa import GenericQAService
-from services.db_qa import DBQAService
+from services.db_qa import DBQAService, ALLOWED
 from services.company_docs_s3_qa import CompanyDocsS3QAService
+from services.cache import build_cache
+from services.intent_rules import LocalIntentRules
 from flask_cors import CORS, cross_origin
 
 load_dotenv()
@@ -20,21 +22,58 @@ POSTGRES_SCHEMA = os.environ["POSTGRES_SCHEMA"]
 BUCKET_NAME = os.environ["BUCKET_NAME"]
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 OPENAI_BASE_URL = os.environ["OPENAI_BASE_URL"]
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_READ_TIMEOUT = float(os.environ.get("OPENAI_READ_TIMEOUT", "20"))
+OPENAI_TOTAL_TIMEOUT = float(os.environ.get("OPENAI_TOTAL_TIMEOUT", "25"))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "2"))
+OPENAI_HEDGE_AFTER_SECONDS = float(os.environ.get("OPENAI_HEDGE_AFTER_SECONDS", "0"))
+OPENAI_POOL_SIZE = int(os.environ.get("OPENAI_POOL_SIZE", "20"))
+OPENAI_STREAM_USAGE = os.environ.get("OPENAI_STREAM_USAGE", "true").lower() == "true"
 MODEL_CLASSIFIER = os.environ["MODEL_CLASSIFIER"]
 MODEL_GENERIC = os.environ["MODEL_GENERIC"]
 MODEL_DB = os.environ["MODEL_DB"]
 MODEL_DOCS = os.environ["MODEL_DOCS"]
 MAX_RESULT_ROWS = int(os.environ["MAX_RESULT_ROWS"])
 COMPANY_FILES_PREFIX = os.environ["COMPANY_FILES_PREFIX"]
+DB_ROLLUP_REWRITE = os.environ.get("DB_ROLLUP_REWRITE", "true").lower() == "true"
+POSTGRES_POOL_MAX = int(os.environ.get("POSTGRES_POOL_MAX", "4"))
+POSTGRES_POOL_HEALTHCHECK_SECONDS = float(os.environ.get("POSTGRES_POOL_HEALTHCHECK_SECONDS", "30"))
+POSTGRES_POOL_WAIT_SECONDS = float(os.environ.get("POSTGRES_POOL_WAIT_SECONDS", "5"))
+POSTGRES_CONNECT_TIMEOUT = int(os.environ.get("POSTGRES_CONNECT_TIMEOUT", "5"))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "15000"))
+REDIS_URL = os.environ.get("REDIS_URL")
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "2000"))
+CACHE_TTL_INTENT = int(os.environ.get("CACHE_TTL_INTENT", "86400"))
+CACHE_TTL_SQL = int(os.environ.get("CACHE_TTL_SQL", "86400"))
+CACHE_TTL_RESULT = int(os.environ.get("CACHE_TTL_RESULT", "3600"))
+DW_VERSION_CHECK_SECONDS = float(os.environ.get("DW_VERSION_CHECK_SECONDS", "60"))
+CLASSIFIER_LOCAL = os.environ.get("CLASSIFIER_LOCAL", "true").lower() == "true"
+CLASSIFIER_RULES_PATH = os.environ.get("CLASSIFIER_RULES_PATH")
+CLASSIFIER_SHADOW_RATE = float(os.environ.get("CLASSIFIER_SHADOW_RATE", "0.05"))
+DOCS_CACHE_MAX_MB = int(os.environ.get("DOCS_CACHE_MAX_MB", "64"))
+DOCS_CACHE_DIR = os.environ.get("DOCS_CACHE_DIR", "/tmp/docs-cache")
+DOCS_CACHE_DISK_MAX_MB = int(os.environ.get("DOCS_CACHE_DISK_MAX_MB", "256"))
+DOCS_LISTING_TTL_SECONDS = float(os.environ.get("DOCS_LISTING_TTL_SECONDS", "60"))
+DOCS_RETRIEVAL = os.environ.get("DOCS_RETRIEVAL", "bm25")
+DOCS_TOP_K = int(os.environ.get("DOCS_TOP_K", "6"))
+DOCS_CHUNK_WORDS = int(os.environ.get("DOCS_CHUNK_WORDS", "180"))
+DOCS_INDEX_PATH = os.environ.get("DOCS_INDEX_PATH", "/tmp/docs-index.json.gz")
+DOCS_FETCH_WORKERS = int(os.environ.get("DOCS_FETCH_WORKERS", "8"))
+DOCS_PARSE_PROCESSES = int(os.environ["DOCS_PARSE_PROCESSES"]) if os.environ.get("DOCS_PARSE_PROCESSES") else None
+DOCS_REFRESH_MODE = os.environ.get("DOCS_REFRESH_MODE", "background")
+DOCS_REFRESH_SECONDS = float(os.environ.get("DOCS_REFRESH_SECONDS", "300"))
+DOCS_SNAPSHOT_PATH = os.environ.get("DOCS_SNAPSHOT_PATH", "/tmp/docs-listing.json")
 
 app = Flask(__name__)
 CORS(app, support_credentials=True)
 
-openai_client = OpenAIClient(OPENAI_API_KEY, OPENAI_BASE_URL)
-classifier = IntentClassifier(openai_client, MODEL_CLASSIFIER)
+response_cache = build_cache(REDIS_URL, CACHE_MAX_ENTRIES, {"intent": CACHE_TTL_INTENT, "sql": CACHE_TTL_SQL, "result": CACHE_TTL_RESULT})
+openai_client = OpenAIClient(OPENAI_API_KEY, OPENAI_BASE_URL, OPENAI_CONNECT_TIMEOUT, OPENAI_READ_TIMEOUT, OPENAI_MAX_RETRIES, OPENAI_HEDGE_AFTER_SECONDS, OPENAI_POOL_SIZE, stream_usage=OPENAI_STREAM_USAGE, total_timeout=OPENAI_TOTAL_TIMEOUT)
 generic_service = GenericQAService(openai_client, MODEL_GENERIC)
-db_service = DBQAService(openai_client, MODEL_DB, POSTGRES_HOST, POSTGRES_PORT, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, MAX_RESULT_ROWS)
-docs_service = CompanyDocsS3QAService(openai_client, MODEL_DOCS, BUCKET_NAME, COMPANY_FILES_PREFIX)
+db_service = DBQAService(openai_client, MODEL_DB, POSTGRES_HOST, POSTGRES_PORT, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, MAX_RESULT_ROWS, DB_ROLLUP_REWRITE, POSTGRES_POOL_MAX, POSTGRES_POOL_HEALTHCHECK_SECONDS, POSTGRES_CONNECT_TIMEOUT, DB_STATEMENT_TIMEOUT_MS, response_cache, DW_VERSION_CHECK_SECONDS, POSTGRES_SCHEMA, POSTGRES_POOL_WAIT_SECONDS)
+docs_service = CompanyDocsS3QAService(openai_client, MODEL_DOCS, BUCKET_NAME, COMPANY_FILES_PREFIX, DOCS_CACHE_MAX_MB, DOCS_CACHE_DIR, DOCS_CACHE_DISK_MAX_MB, DOCS_LISTING_TTL_SECONDS, DOCS_RETRIEVAL, DOCS_TOP_K, DOCS_CHUNK_WORDS, DOCS_INDEX_PATH, 16000, DOCS_FETCH_WORKERS, DOCS_PARSE_PROCESSES, DOCS_REFRESH_MODE, DOCS_REFRESH_SECONDS, DOCS_SNAPSHOT_PATH)
+local_rules = LocalIntentRules(ALLOWED, docs_service.file_names, CLASSIFIER_RULES_PATH) if CLASSIFIER_LOCAL else None
+classifier = IntentClassifier(openai_client, MODEL_CLASSIFIER, response_cache, local_rules, CLASSIFIER_SHADOW_RATE)
 
 @app.get("/health")
 @app.get("/")
@@ -42,6 +81,20 @@ docs_service = CompanyDocsS3QAService(openai_client, MODEL_DOCS, BUCKET_NAME, CO
 def health():
     return jsonify({'message': 'api is running'})
 
+@app.get("/metrics")
+@cross_origin(supports_credentials=True)
+def metrics():
+    return jsonify({"classifier": classifier.metrics(), "db": db_service.metrics(), "docs": docs_service.metrics(), "cache": response_cache.metrics(), "llm": openai_client.metrics()})
+
+@app.post("/docs/refresh")
+@cross_origin(supports_credentials=True)
+def docs_refresh():
+    # Força a comparação da listagem do S3 com o snapshot e reindexa só o que mudou.
+    try:
+        return jsonify({"ok": True, "refresh": docs_service.refresh()})
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Falha ao atualizar documentos: {str(e)}"}), 500
+
 @app.post("/ask")
 @cross_origin(supports_credentials=True)
 def ask():
@@ -61,7 +114,40 @@ def ask():
     except Exception as e:
         return jsonify({"ok": False, "error": f"Falha inesperada: {str(e)}"}), 500
 
+@app.post("/ask/stream")
+@cross_origin(supports_credentials=True)
+def ask_stream():
+    # Server-Sent Events: intent, sql/rows (db) ou files (docs), tokens da resposta e done.
+    payload = request.get_json(force=True, silent=True) or {}
+    question = (payload.get("question") or "").strip()
+    metadata = payload.get("metadata") or {}
+    if not question:
+        return jsonify({"ok": False, "error": "Campo 'question' é obrigatório."}), 400
+
+    def sse(event, data):
+        return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+    def events():
+        ok = True
+        try:
+            intent = classifier.classify(question)
+            yield sse("intent", {"intent": intent})
+            service = db_service if intent == "db" else docs_service if intent == "docs" else generic_service
+            for event, data in service.answer_stream(question, metadata):
+                ok = ok and event != "error"
+                yield sse(event, data)
+        except Exception as e:
+            ok = False
+            yield sse("error", {"error": f"Falha inesperada: {str(e)}"})
+        yield sse("done", {"ok": ok})
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 def handler(event, context):
+    # Notificações do bucket (s3:ObjectCreated / s3:ObjectRemoved no prefixo dos documentos) atualizam o índice direto.
+    records = event.get("Records") or []
+    if records and all(r.get("eventSource") == "aws:s3" for r in records):
+        return docs_service.apply_s3_event(event)
     return awsgi.response(app, event, context)
 
 if __name__ == "__main__":
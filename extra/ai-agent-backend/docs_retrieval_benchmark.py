@@ -0,0 +1,38 @@
+import os
+import sys
+import json
+import time
+from dotenv import load_dotenv
+from services.company_docs_s3_qa import CompanyDocsS3QAService
+
+# Uso: python docs_retrieval_benchmark.py perguntas.json
+# perguntas.json: [{"question": "...", "files": ["company-files/arquivo.pdf", ...]}, ...]
+# Compara o contexto atual (arquivos inteiros concatenados até 16000 caracteres) com os top-k trechos do BM25:
+# recall dos arquivos esperados, tamanho do prompt e tempo para montar o contexto (com documentos já em cache).
+
+load_dotenv()
+with open(sys.argv[1], encoding="utf-8") as fh:
+    perguntas = json.load(fh)
+
+bucket = os.environ["BUCKET_NAME"]
+prefix = os.environ["COMPANY_FILES_PREFIX"]
+modos = {
+    "concatenado": CompanyDocsS3QAService(None, "", bucket, prefix, retrieval="full", index_path=None, refresh_mode="request", snapshot_path=None),
+    "bm25": CompanyDocsS3QAService(None, "", bucket, prefix, retrieval="bm25", index_path=None, refresh_mode="request", snapshot_path=None),
+}
+
+for nome, service in modos.items():
+    service._load_context("aquecimento")
+    recalls, tamanhos, tempos = [], [], []
+    for item in perguntas:
+        started = time.perf_counter()
+        _, used_files, context_body = service._load_context(item["question"])
+        tempos.append((time.perf_counter() - started) * 1000)
+        esperados = set(item["files"])
+        recalls.append(len(esperados & set(used_files)) / len(esperados) if esperados else 1.0)
+        tamanhos.append(len(context_body))
+    tempos.sort()
+    print(
+        f"{nome}: recall médio {sum(recalls) / len(recalls):.2f}, contexto médio {sum(tamanhos) / len(tamanhos):.0f} caracteres "
+        f"(~{sum(tamanhos) / len(tamanhos) / 4:.0f} tokens), mediana {tempos[len(tempos) // 2]:.1f} ms"
+    )
@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import psycopg2
+from dotenv import load_dotenv
+from services.rollup_rewriter import rewrite_to_rollup
+
+# Uso: python rollup_benchmark.py [repeticoes]
+# Compara a latência de consultas agregadas típicas do agente sobre o ft_corrida_taxi com a versão
+# reescrita para os rollups (rl_corrida_*) e confere se os dois resultados batem.
+# As somas dos rollups são float8; sum(vl_*) direto no fato acumula em real, então em consultas com sum
+# uma diferença aponta a perda de precisão do fato, não erro do rollup.
+
+load_dotenv()
+repeticoes = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+CONSULTAS = [
+    ("corridas e ticket médio por mês", "SELECT date_trunc('month', ts_inicio_corrida)::date AS mes, count(*) AS qt_corridas, avg(vl_total) AS vl_medio FROM tlc_trips.ft_corrida_taxi GROUP BY 1 ORDER BY 1 LIMIT 100", {}),
+    ("corridas por hora do dia", "SELECT extract(hour FROM ts_inicio_corrida) AS hora, count(*) AS qt_corridas FROM tlc_trips.ft_corrida_taxi GROUP BY 1 ORDER BY 1 LIMIT 24", {}),
+    ("top zonas de embarque no ano", "SELECT f.cd_zona_embarque, count(*) AS qt_corridas, sum(f.vl_total) AS vl_total FROM tlc_trips.ft_corrida_taxi f WHERE extract(year FROM f.ts_inicio_corrida) = %(p1)s GROUP BY 1 ORDER BY 2 DESC LIMIT 10", {"p1": 2023}),
+    ("gorjeta média por pagamento", "SELECT cd_pagamento, avg(vl_gorjeta) AS vl_gorjeta_media FROM tlc_trips.ft_corrida_taxi GROUP BY cd_pagamento ORDER BY 1 LIMIT 10", {}),
+]
+
+
+def executar(conn, sql, params):
+    tempos = []
+    for _ in range(repeticoes):
+        started = time.perf_counter()
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+        tempos.append((time.perf_counter() - started) * 1000)
+    return sorted(tempos)[len(tempos) // 2], rows
+
+
+def normalizar(rows):
+    return [tuple(round(float(v), 4) if isinstance(v, (int, float)) or type(v).__name__ == "Decimal" else v for v in row) for row in rows]
+
+
+conn = psycopg2.connect(
+    host=os.environ["POSTGRES_HOST"], port=int(os.environ["POSTGRES_PORT"]), dbname=os.environ["POSTGRES_DB"],
+    user=os.environ["POSTGRES_USER"], password=os.environ["POSTGRES_PASSWORD"],
+)
+conn.autocommit = True
+try:
+    for nome, sql, params in CONSULTAS:
+        reescrita, rollup = rewrite_to_rollup(sql)
+        if rollup is None:
+            print(f"{nome}: sem rollup compatível")
+            continue
+        ms_fato, rows_fato = executar(conn, sql, params)
+        ms_rollup, rows_rollup = executar(conn, reescrita, params)
+        iguais = normalizar(rows_fato) == normalizar(rows_rollup)
+        print(f"{nome}: fato {ms_fato:.1f} ms, {rollup} {ms_rollup:.1f} ms ({ms_fato / ms_rollup if ms_rollup else 0:.0f}x), resultados {'iguais' if iguais else 'DIFERENTES'}")
+finally:
+    conn.close()
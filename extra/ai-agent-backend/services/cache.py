@@ -0,0 +1,136 @@
+import re, json, time, hashlib, threading, unicodedata
+from collections import OrderedDict
+
+# Namespaces usados pelo /ask e o TTL padrão (segundos) de cada um. TTL 0 desliga o namespace.
+DEFAULT_TTLS = {"intent": 86400, "sql": 86400, "result": 3600}
+
+
+def normalize_question(question: str) -> str:
+    text = unicodedata.normalize("NFKC", question).casefold()
+    return re.sub(r"\s+", " ", text).strip(" ?!.")
+
+
+def cache_key(*parts) -> str:
+    return hashlib.sha1("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    name = "memory"
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: float):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete_prefix(self, prefix: str):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def size(self) -> int:
+        return len(self._data)
+
+
+class RedisBackend:
+    # A expulsão LRU fica com o próprio Redis (maxmemory-policy allkeys-lru); aqui só TTL.
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "ai-agent:"):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self.prefix = prefix
+        self.evictions = 0
+
+    def get(self, key: str):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value, ttl: float):
+        # JSON, não pickle: um Redis compartilhado não pode virar caminho para executar código no load. Tuplas
+        # voltam como listas e Decimal/datas como texto, que é como a resposta já sai no JSON do /ask.
+        self.client.set(self.prefix + key, json.dumps(value, default=str), ex=max(1, int(ttl)))
+
+    def delete_prefix(self, prefix: str):
+        keys = list(self.client.scan_iter(match=f"{self.prefix}{prefix}*", count=500))
+        for i in range(0, len(keys), 500):
+            self.client.unlink(*keys[i:i + 500])
+
+    def size(self) -> int:
+        return self.client.dbsize()
+
+
+class ResponseCache:
+    def __init__(self, backend, ttls: dict | None = None):
+        self.backend = backend
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.stats = {ns: {"hits": 0, "misses": 0, "sets": 0, "errors": 0} for ns in self.ttls}
+        self._lock = threading.Lock()
+
+    def _count(self, namespace: str, name: str):
+        with self._lock:
+            self.stats[namespace][name] += 1
+
+    def get(self, namespace: str, key: str):
+        if self.ttls[namespace] <= 0:
+            return None
+        try:
+            value = self.backend.get(f"{namespace}:{key}")
+        except Exception:
+            # Cache indisponível vira miss: a resposta segue pelo caminho normal.
+            self._count(namespace, "errors")
+            return None
+        self._count(namespace, "hits" if value is not None else "misses")
+        return value
+
+    def set(self, namespace: str, key: str, value):
+        if self.ttls[namespace] <= 0:
+            return
+        try:
+            self.backend.set(f"{namespace}:{key}", value, self.ttls[namespace])
+            self._count(namespace, "sets")
+        except Exception:
+            self._count(namespace, "errors")
+
+    def invalidate(self, namespace: str):
+        try:
+            self.backend.delete_prefix(f"{namespace}:")
+        except Exception:
+            self._count(namespace, "errors")
+
+    def metrics(self) -> dict:
+        with self._lock:
+            namespaces = {ns: dict(s) for ns, s in self.stats.items()}
+        for s in namespaces.values():
+            lookups = s["hits"] + s["misses"]
+            s["hit_rate"] = round(s["hits"] / lookups, 4) if lookups else 0.0
+        try:
+            size = self.backend.size()
+        except Exception:
+            size = None
+        return {"backend": self.backend.name, "size": size, "evictions": self.backend.evictions, "namespaces": namespaces}
+
+
+def build_cache(redis_url: str | None, max_entries: int, ttls: dict | None = None) -> ResponseCache:
+    backend = RedisBackend(redis_url) if redis_url else MemoryBackend(max_entries)
+    return ResponseCache(backend, ttls)
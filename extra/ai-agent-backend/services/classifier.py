@@ -1,4 +1,7 @@
-import json
+import json, time, random, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from services.cache import normalize_question
 
 SYSTEM = (
     "Você é um classificador estrito. "
@@ -23,16 +26,92 @@ SCHEMA = {
 }
 
 class IntentClassifier:
-    def __init__(self, openai_client, model_name: str):
+    def __init__(self, openai_client, model_name: str, cache=None, local_rules=None, shadow_rate: float = 0.0):
         self.openai = openai_client
         self.model = model_name
+        self.cache = cache
+        self.local_rules = local_rules
+        self.shadow_rate = shadow_rate
+        self._shadow_pool = ThreadPoolExecutor(max_workers=1) if local_rules and shadow_rate > 0 else None
+        self._lock = threading.Lock()
+        self.stats = {
+            "paths": {"local": 0, "cache": 0, "llm": 0},
+            "llm_failures": 0,
+            "intents": {"generic": 0, "db": 0, "docs": 0},
+            "local_checks": 0,
+            "local_us_total": 0.0,
+            "shadow": {"checked": 0, "agreed": 0},
+            "disagreements": deque(maxlen=20),
+        }
+
+    def _record(self, path: str, intent: str):
+        with self._lock:
+            self.stats["paths"][path] += 1
+            self.stats["intents"][intent] = self.stats["intents"].get(intent, 0) + 1
 
     def classify(self, question: str) -> str:
+        if self.local_rules:
+            started = time.perf_counter()
+            intent, _ = self.local_rules.decide(question)
+            with self._lock:
+                self.stats["local_checks"] += 1
+                self.stats["local_us_total"] += (time.perf_counter() - started) * 1e6
+            if intent:
+                self._record("local", intent)
+                if self._shadow_pool and random.random() < self.shadow_rate:
+                    self._shadow_pool.submit(self._shadow_check, question, intent)
+                return intent
+        key = normalize_question(question)
+        intent = self.cache.get("intent", key) if self.cache else None
+        if intent:
+            self._record("cache", intent)
+            return intent
+        intent = self._classify_llm(question)
+        if intent is None:
+            # Falha do LLM (erro ou JSON inválido): cai no generic, sem cache, contada à parte.
+            with self._lock:
+                self.stats["llm_failures"] += 1
+            intent = "generic"
+        elif self.cache:
+            self.cache.set("intent", key, intent)
+        self._record("llm", intent)
+        return intent
+
+    def _classify_llm(self, question: str):
         result = self.openai.chat(self.model, SYSTEM, question, response_format=SCHEMA, temperature=0)
         if not result.get("ok"):
-            return "generic"
+            return None
         try:
             data = json.loads(result["content"])
             return data.get("intent", "generic")
         except Exception:
-            return "generic"
+            return None
+
+    def _shadow_check(self, question: str, local_intent: str):
+        # Amostra das decisões locais também vai ao LLM, só para medir a concordância das regras.
+        llm_intent = self._classify_llm(question)
+        if llm_intent is None:
+            return
+        with self._lock:
+            self.stats["shadow"]["checked"] += 1
+            if llm_intent == local_intent:
+                self.stats["shadow"]["agreed"] += 1
+            else:
+                self.stats["disagreements"].append({"question": question[:120], "local": local_intent, "llm": llm_intent})
+
+    def metrics(self) -> dict:
+        with self._lock:
+            paths = dict(self.stats["paths"])
+            shadow = dict(self.stats["shadow"])
+            data = {
+                "paths": paths,
+                "intents": dict(self.stats["intents"]),
+                "llm_failures": self.stats["llm_failures"],
+                "local_us_avg": round(self.stats["local_us_total"] / self.stats["local_checks"], 1) if self.stats["local_checks"] else 0.0,
+                "disagreements": list(self.stats["disagreements"]),
+            }
+        total = sum(paths.values())
+        data["local_rate"] = round(paths["local"] / total, 4) if total else 0.0
+        shadow["accuracy"] = round(shadow["agreed"] / shadow["checked"], 4) if shadow["checked"] else None
+        data["shadow"] = shadow
+        return data
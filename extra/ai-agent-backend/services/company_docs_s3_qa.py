@@ -1,6 +1,11 @@
-import os, io, boto3
+import os, io, json, time, threading, multiprocessing, urllib.parse, boto3
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pypdf import PdfReader
 from docx import Document
+from services.doc_cache import DocumentCache
+from services.doc_index import BM25Index
 
 SYSTEM_BASE = (
     "Você responde somente com base no CONTEXTO a seguir (trechos de arquivos da empresa). "
@@ -8,23 +13,19 @@ SYSTEM_BASE = (
     "Seja objetivo."
 )
 
+DOC_EXTENSIONS = (".pdf", ".docx", ".doc", ".txt", ".md")
+
 def _read_pdf_bytes(pdf_bytes: bytes) -> str:
-    try:
-        reader = PdfReader(io.BytesIO(pdf_bytes))
-        pages_text = [page.extract_text() or "" for page in reader.pages]
-        
-        return "\n".join(pages_text)
-    except Exception:
-        return ""
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    pages_text = [page.extract_text() or "" for page in reader.pages]
+    
+    return "\n".join(pages_text)
 
 def _read_docx_bytes(docx_bytes: bytes) -> str:
-    try:
-        document = Document(io.BytesIO(docx_bytes))
-        paragraphs_text = [p.text for p in document.paragraphs]
-        
-        return "\n".join(paragraphs_text)
-    except Exception:
-        return ""
+    document = Document(io.BytesIO(docx_bytes))
+    paragraphs_text = [p.text for p in document.paragraphs]
+    
+    return "\n".join(paragraphs_text)
 
 def _read_text_bytes(text_bytes: bytes) -> str:
     try:
@@ -33,8 +34,8 @@ def _read_text_bytes(text_bytes: bytes) -> str:
     except Exception:
         return ""
 
-def _list_s3_objects(s3, bucket: str, prefix: str):
-    object_keys = []
+def _list_s3_entries(s3, bucket: str, prefix: str, strict: bool = False):
+    entries = []
     continuation = None
     while True:
         try:
@@ -45,91 +46,397 @@ def _list_s3_objects(s3, bucket: str, prefix: str):
             for item in response.get("Contents", []):
                 key = item.get("Key", "")
                 if key and not key.endswith("/"):
-                    object_keys.append(key)
+                    entries.append({"key": key, "etag": item.get("ETag", "").strip('"'), "size": item.get("Size", 0), "last_modified": str(item.get("LastModified", ""))})
             if response.get("IsTruncated"):
                 continuation = response.get("NextContinuationToken")
             else:
                 break
         except Exception:
+            # No refresh incremental uma listagem vazia por erro apagaria o índice inteiro.
+            if strict:
+                raise
             break
     
-    return object_keys
+    return entries
+
+def _list_s3_objects(s3, bucket: str, prefix: str):
+    return [entry["key"] for entry in _list_s3_entries(s3, bucket, prefix)]
+
+def _parse_bytes(key: str, raw_bytes: bytes) -> str:
+    lower_key = key.lower()
+    if lower_key.endswith(".pdf"):
+        return _read_pdf_bytes(raw_bytes)
+    if lower_key.endswith((".docx", ".doc")):
+        return _read_docx_bytes(raw_bytes)
+    return _read_text_bytes(raw_bytes)
+
+def _read_object_text(s3, bucket: str, entry: dict, cache=None) -> str:
+    # Com cache, só objetos novos ou com ETag diferente são baixados e extraídos de novo.
+    if cache:
+        text = cache.get(entry["key"], entry["etag"])
+        if text is not None:
+            return text
+    obj = s3.get_object(Bucket=bucket, Key=entry["key"])
+    text = _parse_bytes(entry["key"], obj["Body"].read())
+    if cache:
+        cache.put(entry["key"], entry["etag"], text)
+    return text
+
+def _parse_in_pool(parse_pool, key: str, raw_bytes: bytes, on_broken=None) -> str:
+    # PDF/DOCX são CPU: vão para o pool de processos quando existe; texto puro é decodificado na thread.
+    if parse_pool is None or not key.lower().endswith((".pdf", ".docx", ".doc")):
+        return _parse_bytes(key, raw_bytes)
+    try:
+        return parse_pool.submit(_parse_bytes, key, raw_bytes).result()
+    except BrokenProcessPool:
+        # Um worker morreu (OOM, segfault no parser): o pool não se recupera, então quem o criou descarta e recria.
+        if on_broken:
+            on_broken(parse_pool)
+        return _parse_bytes(key, raw_bytes)
 
-def _load_context_from_s3(s3, bucket: str, prefix: str, max_chars: int = 16000):
+def _load_texts(s3, bucket: str, entries, cache=None, workers: int = 8, parse_pool=None, on_broken=None):
+    """Texto de cada objeto: cache, senão download em paralelo (threads) e extração. Devolve (textos por chave, relatório por arquivo)."""
+    texts = {}
+    pending = []
+    for entry in entries:
+        text = cache.get(entry["key"], entry["etag"]) if cache else None
+        if text is not None:
+            texts[entry["key"]] = text
+        else:
+            pending.append(entry)
+
+    def work(entry):
+        item = {"key": entry["key"], "bytes": entry.get("size", 0), "ok": False}
+        try:
+            started = time.perf_counter()
+            raw_bytes = s3.get_object(Bucket=bucket, Key=entry["key"])["Body"].read()
+            item["fetch_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            started = time.perf_counter()
+            text = _parse_in_pool(parse_pool, entry["key"], raw_bytes, on_broken)
+            item["parse_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            item["ok"] = True
+            if cache:
+                cache.put(entry["key"], entry["etag"], text)
+            return item, text
+        except Exception as e:
+            item["error"] = f"{type(e).__name__}: {e}"
+            return item, None
+
+    report = []
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as pool:
+            for item, text in pool.map(work, pending):
+                report.append(item)
+                if text is not None:
+                    texts[item["key"]] = text
+                if not item["ok"]:
+                    print(f"docs: falha ao ler {item['key']}: {item['error']}")
+        print(f"docs: {len(entries) - len(pending)} do cache, {len(report)} lidos do S3, {sum(1 for i in report if not i['ok'])} com falha")
+    return texts, report
+
+def _load_context_from_s3(s3, bucket: str, prefix: str, max_chars: int = 16000, entries=None, cache=None, workers: int = 8, parse_pool=None, report=None, on_broken=None):
     if not bucket or not prefix:
         
         return "", [], ""
     try:
-        object_keys = _list_s3_objects(s3, bucket, prefix)
-        context_key = ""
-        
-        for key in object_keys:
-            if key.lower().endswith("contextualizacao.txt"):
-                context_key = key
-                break
-        context_instructions = ""
-        
-        if context_key:
-            try:
-                obj = s3.get_object(Bucket=bucket, Key=context_key)
-                context_instructions = _read_text_bytes(obj["Body"].read())
-            except Exception:
-                context_instructions = ""
+        if entries is None:
+            entries = _list_s3_entries(s3, bucket, prefix)
+        context_entry = _context_entry(entries)
+        documents = [entry for entry in entries if entry is not context_entry and entry["key"].lower().endswith(DOC_EXTENSIONS)]
+        texts, load_report = _load_texts(s3, bucket, documents + ([context_entry] if context_entry else []), cache, workers, parse_pool, on_broken)
+        if report is not None:
+            report.extend(load_report)
+        context_instructions = texts.get(context_entry["key"], "") if context_entry else ""
         collected_chunks = []
         used_files = []
         
-        for key in object_keys:
-            if key == context_key:
-                continue
-            lower_key = key.lower()
+        for entry in documents:
+            content_text = texts.get(entry["key"], "")
             
-            if not lower_key.endswith((".pdf", ".docx", ".doc", ".txt", ".md")):
-                continue
-            try:
-                obj = s3.get_object(Bucket=bucket, Key=key)
-                raw_bytes = obj["Body"].read()
-                content_text = ""
-                
-                if lower_key.endswith(".pdf"):
-                    content_text = _read_pdf_bytes(raw_bytes)
-                elif lower_key.endswith((".docx", ".doc")):
-                    content_text = _read_docx_bytes(raw_bytes)
-                else:
-                    content_text = _read_text_bytes(raw_bytes)
-                
-                if content_text:
-                    used_files.append(key)
-                    collected_chunks.append(f"\n[ARQUIVO: {key}]\n{content_text}\n")
-                joined = "\n".join(collected_chunks)
-                
-                if len(joined) >= max_chars:
-                    return context_instructions, used_files, joined[:max_chars]
-            except Exception:
-                continue
+            if content_text:
+                used_files.append(entry["key"])
+                collected_chunks.append(f"\n[ARQUIVO: {entry['key']}]\n{content_text}\n")
+            joined = "\n".join(collected_chunks)
+            
+            if len(joined) >= max_chars:
+                return context_instructions, used_files, joined[:max_chars]
         
         return context_instructions, used_files, "\n".join(collected_chunks)[:max_chars]
     except Exception:
         return "", [], ""
 
+def diff_listing(previous: dict, current: list):
+    """Compara a listagem atual com o snapshot anterior (chave -> entry). Devolve (novos, alterados, removidos)."""
+    current_keys = {entry["key"] for entry in current}
+    added = [entry for entry in current if entry["key"] not in previous]
+    changed = [entry for entry in current if entry["key"] in previous and (previous[entry["key"]]["etag"], previous[entry["key"]]["size"]) != (entry["etag"], entry["size"])]
+    removed = [key for key in previous if key not in current_keys]
+    return added, changed, removed
+
+def _context_entry(entries):
+    return next((entry for entry in entries if entry["key"].lower().endswith("contextualizacao.txt")), None)
+
+def _retrieve_context(index, question: str, top_k: int, max_chars: int):
+    # Só os trechos mais relevantes (BM25) entram no prompt, em ordem de score e agrupados por arquivo.
+    collected_chunks = []
+    used_files = []
+    size = 0
+    for score, key, chunk in index.search(question, top_k):
+        block = f"\n[ARQUIVO: {key}]\n{chunk}\n"
+        if size + len(block) > max_chars and collected_chunks:
+            break
+        collected_chunks.append(block)
+        size += len(block)
+        if key not in used_files:
+            used_files.append(key)
+    return used_files, "\n".join(collected_chunks)[:max_chars]
+
 class CompanyDocsS3QAService:
-    def __init__(self, openai_client, model_name: str, s3_bucket: str, prefix: str):
+    def __init__(self, openai_client, model_name: str, s3_bucket: str, prefix: str,
+                 cache_max_mb: int = 64, cache_dir: str | None = "/tmp/docs-cache", cache_disk_max_mb: int = 256, listing_ttl_seconds: float = 60,
+                 retrieval: str = "bm25", top_k: int = 6, chunk_words: int = 180, index_path: str | None = "/tmp/docs-index.json.gz", max_chars: int = 16000,
+                 fetch_workers: int = 8, parse_processes: int | None = None,
+                 refresh_mode: str = "background", refresh_seconds: float = 300, snapshot_path: str | None = "/tmp/docs-listing.json"):
         self.openai = openai_client
         self.model = model_name
         self.s3_bucket = s3_bucket
         self.prefix = prefix
-        self.s3 = boto3.client("s3")
+        self.fetch_workers = fetch_workers
+        self.s3 = boto3.client("s3", config=Config(max_pool_connections=max(10, fetch_workers)))
+        self.parse_processes = os.cpu_count() if parse_processes is None else parse_processes
+        self._parse_pool = None
+        self._parse_pool_lock = threading.Lock()
+        self.last_load = None
+        self.doc_cache = DocumentCache(cache_max_mb * 1024 * 1024, cache_dir, cache_disk_max_mb * 1024 * 1024)
+        self.listing_ttl_seconds = listing_ttl_seconds
+        self._entries = None
+        self._listed_at = float("-inf")
+        self._names = ()
+        self._names_source = None
+        self.retrieval = retrieval
+        self.top_k = top_k
+        self.max_chars = max_chars
+        self.index_path = index_path
+        if retrieval == "bm25":
+            self.index = BM25Index.load(index_path, chunk_words) if index_path else BM25Index(chunk_words)
+        else:
+            self.index = None
+        self.refresh_mode = refresh_mode
+        self.refresh_seconds = refresh_seconds
+        self.snapshot_path = snapshot_path
+        self.last_refresh = None
+        self._refresh_lock = threading.Lock()
+        self._entries = self._load_snapshot()
+        self._refresher = None
+        self._refresher_lock = threading.Lock()
+
+    def _start_refresher(self):
+        # A thread sobe no primeiro uso, não no construtor: processos que só importam o app (workers do pool de
+        # extração via forkserver/spawn) não devem listar nem baixar nada.
+        if self.refresh_mode == "background" and self._refresher is None and self.s3_bucket and self.prefix:
+            with self._refresher_lock:
+                if self._refresher is None:
+                    self._refresher = threading.Thread(target=self._refresh_loop, name="docs-refresh", daemon=True)
+                    self._refresher.start()
+
+    def entries(self):
+        # Listagem conhecida (chave, ETag, tamanho, LastModified). Em modo background quem atualiza é o refresh periódico;
+        # no modo request a listagem é refeita aqui a cada listing_ttl_seconds. Sem snapshot (cold start), lista uma vez.
+        if not self.s3_bucket or not self.prefix:
+            return []
+        self._start_refresher()
+        if self._entries is None or (self.refresh_mode == "request" and time.monotonic() - self._listed_at >= self.listing_ttl_seconds):
+            self.refresh()
+        return self._entries or []
+
+    def _load_snapshot(self):
+        if not self.snapshot_path:
+            return None
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        return data["entries"] if data.get("bucket") == self.s3_bucket and data.get("prefix") == self.prefix else None
+
+    def _save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        try:
+            with open(self.snapshot_path + ".tmp", "w", encoding="utf-8") as fh:
+                json.dump({"bucket": self.s3_bucket, "prefix": self.prefix, "entries": self._entries}, fh)
+            os.replace(self.snapshot_path + ".tmp", self.snapshot_path)
+        except OSError:
+            pass
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"docs: refresh falhou: {type(e).__name__}: {e}")
+            time.sleep(self.refresh_seconds)
+
+    def _apply_changes(self, upserts, removed):
+        """Atualiza cache e índice só para os objetos novos/alterados e removidos. Devolve as chaves que falharam."""
+        for key in removed:
+            self.doc_cache.discard(key)
+            if self.index:
+                self.index.remove_document(key)
+        wanted = [e for e in upserts if e["key"].lower().endswith(DOC_EXTENSIONS)]
+        if self.index:
+            wanted = [e for e in wanted if e["key"].lower().endswith("contextualizacao.txt") or self.index.etag(e["key"]) != e["etag"]]
+        failed = set()
+        if wanted:
+            started = time.perf_counter()
+            texts, report = _load_texts(self.s3, self.s3_bucket, wanted, self.doc_cache, self.fetch_workers, self.parse_pool(), self._discard_parse_pool)
+            self._record_load(report, started)
+            failed = {item["key"] for item in report if not item["ok"]}
+            if self.index:
+                for entry in wanted:
+                    if entry["key"] in texts and not entry["key"].lower().endswith("contextualizacao.txt"):
+                        self.index.add_document(entry["key"], entry["etag"], texts[entry["key"]])
+        if self.index and self.index_path and (wanted or removed):
+            try:
+                self.index.save(self.index_path)
+            except OSError:
+                pass
+        return failed
+
+    def refresh(self):
+        """Lista o prefixo, compara com o snapshot e aplica só a diferença."""
+        with self._refresh_lock:
+            started = time.perf_counter()
+            current = _list_s3_entries(self.s3, self.s3_bucket, self.prefix, strict=True)
+            previous = {entry["key"]: entry for entry in (self._entries or [])}
+            if self.index:
+                # Snapshot e índice podem divergir (índice perdido no /tmp, DOCS_INDEX_PATH alterado): o que não está
+                # indexado com o mesmo ETag conta como novo.
+                previous = {key: entry for key, entry in previous.items()
+                            if not key.lower().endswith(DOC_EXTENSIONS) or key.lower().endswith("contextualizacao.txt") or self.index.etag(key) == entry["etag"]}
+            added, changed, removed = diff_listing(previous, current)
+            failed = self._apply_changes(added + changed, removed) if added or changed or removed else set()
+            # Arquivos com falha ficam fora do snapshot para entrarem de novo como "novos" no próximo refresh.
+            self._entries = [entry for entry in current if entry["key"] not in failed]
+            self._listed_at = time.monotonic()
+            self._save_snapshot()
+            self.last_refresh = {
+                "at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "added": len(added), "changed": len(changed), "removed": len(removed), "failed": sorted(failed),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+            }
+            return self.last_refresh
+
+    def apply_s3_event(self, event: dict):
+        """Hook para notificações do S3 (ObjectCreated/ObjectRemoved): atualiza só os objetos do evento, sem listar o prefixo."""
+        with self._refresh_lock:
+            entries = {entry["key"]: entry for entry in (self._entries or [])}
+            upserts, removed = [], []
+            for record in event.get("Records", []):
+                obj = record.get("s3", {}).get("object", {})
+                key = urllib.parse.unquote_plus(obj.get("key", ""))
+                if not key.startswith(self.prefix) or key.endswith("/"):
+                    continue
+                if record.get("eventName", "").startswith("ObjectRemoved"):
+                    removed.append(key)
+                    entries.pop(key, None)
+                else:
+                    entry = {"key": key, "etag": obj.get("eTag", ""), "size": obj.get("size", 0), "last_modified": record.get("eventTime", "")}
+                    upserts.append(entry)
+                    entries[key] = entry
+            failed = self._apply_changes(upserts, removed)
+            self._entries = [entry for key, entry in entries.items() if key not in failed]
+            self._save_snapshot()
+            return {"upserted": len(upserts), "removed": len(removed), "failed": sorted(failed)}
+
+    def file_names(self):
+        # Vocabulário do classificador local, chamado a cada pergunta: lê a listagem atual sem listar o S3 nem esperar
+        # o refresh (vazia até o primeiro terminar). A tupla só é refeita quando o refresh troca a listagem.
+        self._start_refresher()
+        entries = self._entries
+        if entries is not self._names_source:
+            self._names = tuple(entry["key"] for entry in entries or [])
+            self._names_source = entries
+        return self._names
+
+    def metrics(self):
+        data = {"cache": self.doc_cache.snapshot(), "files": len(self._entries or []), "retrieval": self.retrieval, "last_load": self.last_load, "last_refresh": self.last_refresh}
+        if self.index:
+            data["index"] = {"documents": len(self.index.docs), "chunks": self.index.n_chunks, "terms": len(self.index.postings)}
+        return data
+
+    def parse_pool(self):
+        # Na Lambda não há /dev/shm e o pool de processos não sobe; aí a extração fica nas threads.
+        # Workers via forkserver (spawn onde não houver): o pool é criado a partir das threads de refresh/requisição,
+        # e um fork herdaria locks presos de boto3/httpx.
+        with self._parse_pool_lock:
+            if self._parse_pool is None and self.parse_processes and self.parse_processes > 1:
+                try:
+                    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                    self._parse_pool = ProcessPoolExecutor(max_workers=self.parse_processes, mp_context=multiprocessing.get_context(method))
+                except (OSError, NotImplementedError) as e:
+                    print(f"docs: pool de processos indisponível ({e}); extração nas threads")
+                    self.parse_processes = 0
+            return self._parse_pool
+
+    def _discard_parse_pool(self, pool):
+        with self._parse_pool_lock:
+            if self._parse_pool is pool:
+                print("docs: pool de processos quebrado; será recriado na próxima carga")
+                self._parse_pool = None
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    def _record_load(self, report, started):
+        if report:
+            self.last_load = {
+                "files": len(report),
+                "failed": [{"key": i["key"], "error": i["error"]} for i in report if not i["ok"]],
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                "slowest": sorted(report, key=lambda i: i.get("fetch_ms", 0) + i.get("parse_ms", 0), reverse=True)[:5],
+            }
+
+    def _load_full_context(self, entries):
+        started = time.perf_counter()
+        report = []
+        result = _load_context_from_s3(self.s3, self.s3_bucket, self.prefix, self.max_chars, entries, self.doc_cache, self.fetch_workers, self.parse_pool(), report, self._discard_parse_pool)
+        self._record_load(report, started)
+        return result
+
+    def _load_context(self, question: str):
+        entries = self.entries()
+        if not self.index:
+            return self._load_full_context(entries)
+        context_instructions = ""
+        context_entry = _context_entry(entries)
+        if context_entry:
+            try:
+                context_instructions = _read_object_text(self.s3, self.s3_bucket, context_entry, self.doc_cache)
+            except Exception:
+                context_instructions = ""
+        used_files, context_body = _retrieve_context(self.index, question, self.top_k, self.max_chars)
+        if not context_body:
+            return self._load_full_context(entries)
+        return context_instructions, used_files, context_body
+
+    def _messages(self, question: str):
+        if not self.s3_bucket:
+            return None, "S3_BUCKET não configurado"
+        context_instructions, used_files, context_body = self._load_context(question)
+        
+        if not context_body:
+            return None, "Nenhum arquivo válido encontrado no S3 ou leitura indisponível"
+        
+        system_message = (context_instructions.strip() + "\n\n" + SYSTEM_BASE) if context_instructions else SYSTEM_BASE
+        user_message = f"CONTEXTO:\n{context_body}\n\nPERGUNTA:\n{question}\n\nResponda somente com base no CONTEXTO."
+        return (system_message, user_message, used_files), None
 
     def answer(self, question: str, metadata: dict):
         try:
-            if not self.s3_bucket:
-                return {"ok": False, "intent": "docs", "error": "S3_BUCKET não configurado"}
-            context_instructions, used_files, context_body = _load_context_from_s3(self.s3, self.s3_bucket, self.prefix)
-            
-            if not context_body:
-                return {"ok": False, "intent": "docs", "error": "Nenhum arquivo válido encontrado no S3 ou leitura indisponível"}
+            messages, error = self._messages(question)
             
-            system_message = (context_instructions.strip() + "\n\n" + SYSTEM_BASE) if context_instructions else SYSTEM_BASE
-            user_message = f"CONTEXTO:\n{context_body}\n\nPERGUNTA:\n{question}\n\nResponda somente com base no CONTEXTO."
+            if error:
+                return {"ok": False, "intent": "docs", "error": error}
+            system_message, user_message, used_files = messages
             result = self.openai.chat(self.model, system_message, user_message, temperature=0)
             
             if not result.get("ok"):
@@ -137,3 +444,20 @@ class CompanyDocsS3QAService:
             return {"ok": True, "intent": "docs", "files": used_files, "answer": result["content"]}
         except Exception as e:
             return {"ok": False, "intent": "docs", "error": f"Falha no módulo Docs S3: {str(e)}"}
+
+    def answer_stream(self, question: str, metadata: dict):
+        try:
+            messages, error = self._messages(question)
+            
+            if error:
+                yield "error", {"error": error}
+                return
+            system_message, user_message, used_files = messages
+            yield "files", {"files": used_files}
+            for chunk in self.openai.chat_stream(self.model, system_message, user_message, temperature=0):
+                if not chunk.get("ok"):
+                    yield "error", {"error": chunk.get("error", "Falha no OpenAI")}
+                    return
+                yield "token", {"text": chunk["delta"]}
+        except Exception as e:
+            yield "error", {"error": f"Falha no módulo Docs S3: {str(e)}"}
@@ -1,4 +1,8 @@
-import json, psycopg2, sqlparse, re
+import json, time, psycopg2, sqlparse, re
+from collections import OrderedDict
+from services.cache import normalize_question, cache_key
+from services.pg_pool import get_pool
+from services.rollup_rewriter import rewrite_to_rollup
 
 SYSTEM_SQL = (
     "Você gera uma consulta SELECT segura em Postgres usando o schema tlc_trips. "
@@ -19,38 +23,156 @@ ALLOWED = {
     "tlc_trips.ft_corrida_taxi": ["cd_empresa","qt_passageiros","vl_total","ts_inicio_corrida","ts_fim_corrida","vl_distancia_mi","cd_tarifa","fl_transmissao","cd_zona_embarque","cd_zona_desembarque","cd_pagamento","vl_tarifa_base","vl_extra","vl_mta_tax","vl_gorjeta","vl_pedagio","vl_sobretaxa_melhoria","vl_sobretaxa_congestionamento","vl_taxa_aeroporto"]
 }
 
+PREPARED_CACHE_SIZE = 256
+
 def _schema_text():
     return "\n".join([f"{t}({', '.join(cols)})" for t, cols in ALLOWED.items()])
 
+def _clamp_limit(sql_text: str, max_rows: int) -> str:
+    # Garante no banco no máximo max_rows linhas: reduz o LIMIT do SELECT externo ou acrescenta um.
+    sql_text = sqlparse.format(sql_text, strip_comments=True).strip().rstrip(";").rstrip()
+    tokens = list(sqlparse.parse(sql_text)[0].tokens)
+    if any(tok.is_keyword and tok.normalized == "FETCH" for tok in tokens):
+        return f"SELECT * FROM ({sql_text}) AS limitado LIMIT {max_rows}"
+    for i, tok in enumerate(tokens):
+        if not (tok.is_keyword and tok.normalized == "LIMIT"):
+            continue
+        j = next((k for k in range(i + 1, len(tokens)) if not tokens[k].is_whitespace), None)
+        if j is None:
+            break
+        value = tokens[j]
+        if value.ttype is sqlparse.tokens.Literal.Number.Integer:
+            limit = str(min(int(value.value), max_rows))
+        elif value.is_keyword and value.normalized == "ALL":
+            limit = str(max_rows)
+        else:
+            limit = f"LEAST({value}, {max_rows})"
+        return "".join(limit if k == j else str(t) for k, t in enumerate(tokens))
+    return f"{sql_text} LIMIT {max_rows}"
+
 class DBQAService:
-    def __init__(self, openai_client, model_name: str, host: str, port: int, db: str, user: str, password: str, max_rows: int):
+    def __init__(self, openai_client, model_name: str, host: str, port: int, db: str, user: str, password: str, max_rows: int, rollup_rewrite: bool = True,
+                 pool_max_size: int = 4, pool_health_check_seconds: float = 30, connect_timeout: int = 5, statement_timeout_ms: int = 15000,
+                 cache=None, dw_version_check_seconds: float = 60, schema: str = "tlc_trips",
+                 pool_wait_seconds: float = 5):
         self.openai = openai_client
         self.model = model_name
-        self.pg_conn_info = dict(host=host, port=port, dbname=db, user=user, password=password)
+        self.pg_conn_info = dict(host=host, port=port, dbname=db, user=user, password=password, connect_timeout=connect_timeout)
         self.max_rows = max_rows
+        self.rollup_rewrite = rollup_rewrite
+        self.statement_timeout_ms = statement_timeout_ms
+        self.pool = get_pool(self.pg_conn_info, pool_max_size, pool_health_check_seconds, pool_wait_seconds)
+        self._prepared = OrderedDict()
+        self.prepared_stats = {"hits": 0, "misses": 0}
+        self.cache = cache
+        self.dw_version_check_seconds = dw_version_check_seconds
+        self.schema = schema
+        self._dw_version = None
+        self._dw_version_checked_at = float("-inf")
 
     def answer(self, question: str, metadata: dict):
+        result = {"ok": True, "intent": "db"}
+        for event, data in self.answer_stream(question, metadata):
+            if event == "error":
+                return {"ok": False, "intent": "db", "error": data["error"]}
+            result.update(data)
+        return result
+
+    def answer_stream(self, question: str, metadata: dict):
+        # Eventos na ordem em que ficam prontos: ("sql", ...) depois de gerar e ("rows", ...) depois de executar.
         try:
-            prompt_text = f"Pergunta: {question}\nTabelas permitidas:\n{_schema_text()}\nGere JSON com sql, params, rationale."
-            generation = self.openai.chat(self.model, SYSTEM_SQL, prompt_text, response_format={"type": "json_object"}, temperature=0)
-            
-            if not generation.get("ok"):
-                return {"ok": False, "intent": "db", "error": generation.get("error", "Falha ao gerar SQL")}
+            sql_text, params_dict, generation_error = self._generate_sql(question)
             
-            parsed_json = json.loads(generation["content"])
-            sql_text = parsed_json.get("sql", "")
-            params_dict = parsed_json.get("params", {}) or {}
-            is_valid, error_message = self._validate_sql(sql_text)
+            if generation_error:
+                yield "error", {"error": generation_error}
+                return
+            is_valid, error_message, exec_sql, rollup = self._prepare(sql_text)
             
             if not is_valid:
-                return {"ok": False, "intent": "db", "error": f"SQL inválida: {error_message}"}
-            rows, columns, exec_error = self._execute(sql_text, params_dict)
+                yield "error", {"error": f"SQL inválida: {error_message}"}
+                return
+            yield "sql", {"sql": exec_sql, "params": params_dict, "rollup": rollup}
+            rows, columns, exec_error = self._cached_execute(exec_sql, params_dict)
+            
+            if exec_error and rollup:
+                exec_sql, rollup = _clamp_limit(sql_text, self.max_rows), None
+                yield "sql", {"sql": exec_sql, "params": params_dict, "rollup": rollup}
+                rows, columns, exec_error = self._cached_execute(exec_sql, params_dict)
             
             if exec_error:
-                return {"ok": False, "intent": "db", "error": exec_error}
-            return {"ok": True, "intent": "db", "sql": sql_text, "params": params_dict, "columns": columns, "rows": rows[: self.max_rows]}
+                yield "error", {"error": exec_error}
+                return
+            yield "rows", {"columns": columns, "rows": rows[: self.max_rows]}
         except Exception as e:
-            return {"ok": False, "intent": "db", "error": f"Falha no módulo DB: {str(e)}"}
+            yield "error", {"error": f"Falha no módulo DB: {str(e)}"}
+
+    def _generate_sql(self, question: str):
+        key = normalize_question(question)
+        cached = self.cache.get("sql", key) if self.cache else None
+        if cached:
+            return cached["sql"], cached["params"], None
+        prompt_text = f"Pergunta: {question}\nTabelas permitidas:\n{_schema_text()}\nGere JSON com sql, params, rationale."
+        generation = self.openai.chat(self.model, SYSTEM_SQL, prompt_text, response_format={"type": "json_object"}, temperature=0)
+        
+        if not generation.get("ok"):
+            return "", {}, generation.get("error", "Falha ao gerar SQL")
+        
+        parsed_json = json.loads(generation["content"])
+        sql_text = parsed_json.get("sql", "")
+        params_dict = parsed_json.get("params", {}) or {}
+        if self.cache and self._prepare(sql_text)[0]:
+            self.cache.set("sql", key, {"sql": sql_text, "params": params_dict})
+        return sql_text, params_dict, None
+
+    def _cached_execute(self, sql_text: str, params_dict: dict):
+        if not self.cache:
+            return self._execute(sql_text, params_dict)
+        key = cache_key(self._current_dw_version(), sql_text, json.dumps(params_dict, sort_keys=True, default=str))
+        cached = self.cache.get("result", key)
+        if cached:
+            return cached["rows"], cached["columns"], None
+        rows, columns, exec_error = self._execute(sql_text, params_dict)
+        if not exec_error:
+            self.cache.set("result", key, {"rows": rows, "columns": columns})
+        return rows, columns, exec_error
+
+    def _current_dw_version(self):
+        # Versão = última carga registrada pelo refined_to_dw em <schema>.dw_carga. Quando muda, os resultados antigos saem do cache.
+        now = time.monotonic()
+        if now - self._dw_version_checked_at < self.dw_version_check_seconds:
+            return self._dw_version
+        self._dw_version_checked_at = now
+        def run(conn):
+            with conn, conn.cursor() as cur:
+                cur.execute(f"SELECT max(carregado_em)::text FROM {self.schema}.dw_carga")
+                return cur.fetchone()[0]
+        try:
+            version = self.pool.run(run)
+        except psycopg2.Error:
+            return self._dw_version
+        if version != self._dw_version and self._dw_version is not None:
+            self.cache.invalidate("result")
+        self._dw_version = version
+        return version
+
+    def metrics(self):
+        return {"pool": self.pool.snapshot(), "prepared": dict(self.prepared_stats, size=len(self._prepared))}
+
+    def _prepare(self, sql_text: str):
+        # Validação e reescrita por formato de consulta: a mesma SQL parametrizada (valores em params) reaproveita o resultado.
+        if sql_text in self._prepared:
+            self._prepared.move_to_end(sql_text)
+            self.prepared_stats["hits"] += 1
+            return self._prepared[sql_text]
+        self.prepared_stats["misses"] += 1
+        is_valid, error_message = self._validate_sql(sql_text)
+        exec_sql, rollup = rewrite_to_rollup(sql_text) if is_valid and self.rollup_rewrite else (sql_text, None)
+        if is_valid:
+            exec_sql = _clamp_limit(exec_sql, self.max_rows)
+        self._prepared[sql_text] = (is_valid, error_message, exec_sql, rollup)
+        if len(self._prepared) > PREPARED_CACHE_SIZE:
+            self._prepared.popitem(last=False)
+        return self._prepared[sql_text]
 
     def _validate_sql(self, sql_text: str):
         if not sql_text:
@@ -89,12 +211,19 @@ class DBQAService:
             return False, f"Erro ao validar SQL: {str(e)}"
 
     def _execute(self, sql_text: str, params_dict: dict):
-        try:
-            with psycopg2.connect(**self.pg_conn_info) as conn:
+        def run(conn):
+            with conn:
                 with conn.cursor() as cur:
+                    cur.execute("SET LOCAL statement_timeout = %s", (self.statement_timeout_ms,))
+                # Cursor nomeado (server-side): as linhas ficam no Postgres e só max_rows atravessam a rede.
+                with conn.cursor(name="dbqa_resultado") as cur:
                     cur.execute(sql_text, params_dict)
-                    columns = [d[0] for d in cur.description]
-                    rows = cur.fetchall()
+                    rows = cur.fetchmany(self.max_rows)
+                    return rows, [d[0] for d in cur.description]
+        try:
+            rows, columns = self.pool.run(run)
             return rows, columns, None
+        except psycopg2.errors.QueryCanceled:
+            return [], [], f"Consulta excedeu o tempo limite de {self.statement_timeout_ms} ms"
         except Exception as e:
             return [], [], f"Erro ao executar SQL: {str(e)}"
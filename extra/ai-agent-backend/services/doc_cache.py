@@ -0,0 +1,97 @@
+import os, json, hashlib, threading
+from collections import OrderedDict
+
+
+class DocumentCache:
+    """Texto extraído dos documentos, por chave S3 + ETag, em memória (LRU por tamanho) e em disco no /tmp da Lambda."""
+
+    def __init__(self, max_bytes: int, disk_dir: str | None = "/tmp/docs-cache", disk_max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_errors": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _remember(self, key: str, etag: str, text: str):
+        size = len(text.encode("utf-8"))
+        if key in self._data:
+            self._bytes -= self._data.pop(key)[2]
+        self._data[key] = (etag, text, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes and len(self._data) > 1:
+            _, (_, _, evicted) = self._data.popitem(last=False)
+            self._bytes -= evicted
+            self.stats["evictions"] += 1
+
+    def _read_disk(self, key: str, etag: str):
+        try:
+            with open(self._path(key), encoding="utf-8") as fh:
+                item = json.load(fh)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self.stats["disk_errors"] += 1
+            return None
+        return item["text"] if item.get("key") == key and item.get("etag") == etag else None
+
+    def _write_disk(self, key: str, etag: str, text: str):
+        try:
+            path = self._path(key)
+            with open(path + ".tmp", "w", encoding="utf-8") as fh:
+                json.dump({"key": key, "etag": etag, "text": text}, fh)
+            os.replace(path + ".tmp", path)
+            self._trim_disk()
+        except Exception:
+            self.stats["disk_errors"] += 1
+
+    def _trim_disk(self):
+        files = [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir) if name.endswith(".json")]
+        files = sorted((os.stat(path).st_atime, os.stat(path).st_size, path) for path in files)
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def get(self, key: str, etag: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item and item[0] == etag:
+                self._data.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return item[1]
+            text = self._read_disk(key, etag) if self.disk_dir else None
+            if text is not None:
+                self._remember(key, etag, text)
+                self.stats["disk_hits"] += 1
+                return text
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key: str, etag: str, text: str):
+        with self._lock:
+            self._remember(key, etag, text)
+            if self.disk_dir:
+                self._write_disk(key, etag, text)
+
+    def discard(self, key: str):
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[2]
+            if self.disk_dir:
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, entries=len(self._data), memory_bytes=self._bytes, max_bytes=self.max_bytes)
@@ -0,0 +1,114 @@
+import os, re, gzip, json, math, threading
+from collections import Counter
+from services.intent_rules import plain_text
+
+STOPWORDS = {
+    "a", "o", "as", "os", "de", "da", "do", "das", "dos", "e", "em", "no", "na", "nos", "nas", "um", "uma", "para", "por",
+    "com", "sem", "que", "qual", "quais", "se", "ao", "aos", "ou", "mais", "menos", "como", "sao", "ser", "foi", "tem",
+    "the", "of", "and", "to", "in", "is", "for", "on",
+}
+
+
+def tokenize(text: str) -> list:
+    return [w for w in re.findall(r"[a-z0-9]+", plain_text(text)) if len(w) > 1 and w not in STOPWORDS]
+
+
+def chunk_text(text: str, chunk_words: int = 180, overlap_words: int = 40) -> list:
+    words = text.split()
+    if not words:
+        return []
+    step = max(1, chunk_words - overlap_words)
+    return [" ".join(words[i:i + chunk_words]) for i in range(0, max(1, len(words) - overlap_words), step)]
+
+
+class BM25Index:
+    """Índice BM25 dos trechos dos documentos, atualizável por documento e salvo como JSON gzip.
+    O lock permite que o refresh em background altere o índice enquanto requisições fazem busca."""
+
+    def __init__(self, chunk_words: int = 180, overlap_words: int = 40, k1: float = 1.5, b: float = 0.75):
+        self.chunk_words = chunk_words
+        self.overlap_words = overlap_words
+        self.k1 = k1
+        self.b = b
+        self.docs = {}
+        self.postings = {}
+        self.df = Counter()
+        self.total_len = 0
+        self.n_chunks = 0
+        self._lock = threading.RLock()
+
+    def etag(self, key: str):
+        doc = self.docs.get(key)
+        return doc["etag"] if doc else None
+
+    def add_document(self, key: str, etag: str, text: str, chunks: list | None = None):
+        chunks = chunks if chunks is not None else chunk_text(text, self.chunk_words, self.overlap_words)
+        counts = [Counter(tokenize(chunk)) for chunk in chunks]
+        with self._lock:
+            if key in self.docs:
+                self.remove_document(key)
+            lengths = []
+            for i, tf in enumerate(counts):
+                lengths.append(sum(tf.values()))
+                for term, count in tf.items():
+                    self.postings.setdefault(term, {})[(key, i)] = count
+                    self.df[term] += 1
+            self.docs[key] = {"etag": etag, "chunks": chunks, "lengths": lengths}
+            self.total_len += sum(lengths)
+            self.n_chunks += len(chunks)
+
+    def remove_document(self, key: str):
+        with self._lock:
+            doc = self.docs.pop(key, None)
+            if not doc:
+                return
+            for i, chunk in enumerate(doc["chunks"]):
+                for term in set(tokenize(chunk)):
+                    self.postings[term].pop((key, i), None)
+                    if not self.postings[term]:
+                        del self.postings[term]
+                    self.df[term] -= 1
+                    if self.df[term] <= 0:
+                        del self.df[term]
+            self.total_len -= sum(doc["lengths"])
+            self.n_chunks -= len(doc["chunks"])
+
+    def search(self, query: str, k: int = 6) -> list:
+        """Top-k trechos como (score, chave, texto)."""
+        terms = set(tokenize(query))
+        with self._lock:
+            if not self.n_chunks:
+                return []
+            avg_len = self.total_len / self.n_chunks or 1
+            scores = Counter()
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (self.n_chunks - self.df[term] + 0.5) / (self.df[term] + 0.5))
+                for (key, i), tf in postings.items():
+                    length = self.docs[key]["lengths"][i]
+                    scores[(key, i)] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_len))
+            return [(score, key, self.docs[key]["chunks"][i]) for (key, i), score in scores.most_common(k)]
+
+    def save(self, path: str):
+        with self._lock:
+            data = {"chunk_words": self.chunk_words, "overlap_words": self.overlap_words,
+                    "docs": {key: {"etag": doc["etag"], "chunks": doc["chunks"]} for key, doc in self.docs.items()}}
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as fh:
+            json.dump(data, fh, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str, chunk_words: int = 180, overlap_words: int = 40):
+        index = cls(chunk_words, overlap_words)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return index
+        if (data.get("chunk_words"), data.get("overlap_words")) != (chunk_words, overlap_words):
+            return index
+        for key, doc in data["docs"].items():
+            index.add_document(key, doc["etag"], "", doc["chunks"])
+        return index
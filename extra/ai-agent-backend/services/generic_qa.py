@@ -10,3 +10,10 @@ class GenericQAService:
         if not result.get("ok"):
             return {"ok": False, "intent": "generic", "error": result.get("error", "Erro desconhecido")}
         return {"ok": True, "intent": "generic", "answer": result["content"]}
+
+    def answer_stream(self, question: str, metadata: dict):
+        for chunk in self.openai.chat_stream(self.model, SYSTEM, question, temperature=0.2):
+            if not chunk.get("ok"):
+                yield "error", {"error": chunk.get("error", "Erro desconhecido")}
+                return
+            yield "token", {"text": chunk["delta"]}
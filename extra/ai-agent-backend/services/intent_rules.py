@@ -0,0 +1,104 @@
+import re, json, time, unicodedata
+
+# Expressões por intent (sem acento, minúsculas), peso 2 cada; o vocabulário das tabelas e os nomes dos documentos
+# também pesam 2 por palavra. Só termos do domínio: palavras comuns ("maior", "total de", "media") aparecem em
+# qualquer pergunta e não podem decidir sozinhas.
+DEFAULT_KEYWORDS = {
+    "db": [
+        "corrida de taxi", "corridas de taxi", "yellow taxi", "tlc", "zona de embarque", "zona de desembarque",
+        "forma de pagamento", "tipo de pagamento", "codigo de tarifa", "taxa de aeroporto", "taxa de congestionamento",
+    ],
+    "docs": [
+        "documento", "documentos", "politica interna", "manual", "contrato", "regulamento", "procedimento interno",
+        "historia da empresa", "missao da empresa", "visao da empresa", "valores da empresa", "onboarding",
+        "segundo o documento", "nos documentos",
+    ],
+    "generic": [
+        "oi", "ola", "bom dia", "boa tarde", "boa noite", "obrigado", "obrigada", "quem e voce", "o que voce faz",
+        "traduza", "resuma", "escreva", "explique o que e", "o que significa",
+    ],
+}
+
+_PREFIXOS_COLUNA = {"cd", "ds", "vl", "qt", "sk", "fl", "ts", "dt", "nr", "dim", "ft", "mi", "tlc", "trips"}
+# Partes de nomes de colunas que são palavras comuns em qualquer pergunta.
+_PALAVRAS_COLUNA_IGNORADAS = {
+    "ano", "base", "calendario", "dia", "distancia", "empresa", "extra", "fim", "inicio", "melhoria", "mes",
+    "pagamento", "servico", "tax", "taxa", "total", "transmissao", "trimestre",
+}
+_PALAVRAS_ARQUIVO_IGNORADAS = {"contextualizacao", "company", "files", "final", "versao", "pdf", "docx", "txt"}
+
+
+def plain_text(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", text.casefold()) if not unicodedata.combining(c))
+
+
+def _words(text: str) -> set:
+    return set(re.findall(r"[a-z0-9]+", plain_text(text)))
+
+
+def _singular(words: set) -> set:
+    # "corridas" encontra "corrida" do vocabulário; o plural simples com "s" cobre quase todo o vocabulário do DW.
+    return words | {w[:-1] for w in words if len(w) > 4 and w.endswith("s")}
+
+
+def db_vocabulary(allowed: dict) -> set:
+    words = set()
+    for table_name, columns in allowed.items():
+        for name in [table_name, *columns]:
+            words |= {
+                w for w in re.split(r"[._]", name.lower())
+                if len(w) >= 3 and w not in _PREFIXOS_COLUNA and w not in _PALAVRAS_COLUNA_IGNORADAS
+            }
+    return words
+
+
+class LocalIntentRules:
+    """Primeiro estágio do classificador: decide localmente, por palavras-chave, quando há folga clara entre os intents."""
+
+    def __init__(self, allowed: dict, doc_names=None, rules_path: str | None = None, min_score: int = 4, min_margin: int = 4):
+        keywords = {intent: list(words) for intent, words in DEFAULT_KEYWORDS.items()}
+        if rules_path:
+            with open(rules_path, encoding="utf-8") as fh:
+                custom = json.load(fh)
+            for intent in keywords:
+                keywords[intent] += [plain_text(k) for k in custom.get(intent, [])]
+            min_score = custom.get("min_score", min_score)
+            min_margin = custom.get("min_margin", min_margin)
+        self.patterns = {intent: [re.compile(rf"\b{re.escape(k)}\b") for k in words] for intent, words in keywords.items()}
+        self.db_words = db_vocabulary(allowed)
+        self.doc_names = doc_names
+        self._doc_names_seen = None
+        self._doc_words_cache = set()
+        self.min_score = min_score
+        self.min_margin = min_margin
+
+    def _doc_words(self) -> set:
+        if not self.doc_names:
+            return set()
+        names = self.doc_names()
+        # Recalcula só quando a lista de arquivos muda (o serviço de documentos devolve o mesmo objeto entre refreshes).
+        if names is not self._doc_names_seen:
+            words = set()
+            for name in names:
+                base = name.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+                words |= {w for w in _words(base) if len(w) >= 4 and w not in _PALAVRAS_ARQUIVO_IGNORADAS}
+            self._doc_words_cache = words
+            self._doc_names_seen = names
+        return self._doc_words_cache
+
+    def scores(self, question: str) -> dict:
+        text = plain_text(question)
+        words = _singular(_words(text))
+        scores = {intent: 2 * sum(1 for p in patterns if p.search(text)) for intent, patterns in self.patterns.items()}
+        scores["db"] += 2 * len(words & self.db_words)
+        scores["docs"] += 2 * len(words & self._doc_words())
+        return scores
+
+    def decide(self, question: str):
+        """Devolve (intent, scores); intent é None quando a pergunta é ambígua e deve ir para o LLM."""
+        scores = self.scores(question)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        (best, top), (_, second) = ranked[0], ranked[1]
+        if top >= self.min_score and top - second >= self.min_margin:
+            return best, scores
+        return None, scores
@@ -1,24 +1,237 @@
-from openai import OpenAI
+import time, random, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import httpx
+from openai import OpenAI, DefaultHttpxClient, APIStatusError, APIConnectionError
+
+# Threads das requisições "hedged" (segunda chamada disparada quando a primeira demora).
+_HEDGE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="openai-hedge")
+
+
+def _retryable(e: Exception) -> bool:
+    # 429 e 5xx do provedor, timeouts e falhas de conexão; 4xx de requisição inválida não adianta repetir.
+    if isinstance(e, APIConnectionError):
+        return True
+    return isinstance(e, APIStatusError) and (e.status_code == 429 or e.status_code >= 500)
+
+
+def _retry_after(e: Exception):
+    if not isinstance(e, APIStatusError):
+        return None
+    try:
+        return float(e.response.headers.get("retry-after", ""))
+    except ValueError:
+        return None
+
+
+def _percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 1)
+
 
 class OpenAIClient:
-    def __init__(self, api_key: str, base_url: str):
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+    """Cliente do LLM com pool HTTP compartilhado, timeouts, retries com jitter, hedging opcional e métricas por chamada."""
+
+    def __init__(self, api_key: str, base_url: str, connect_timeout: float = 5.0, read_timeout: float = 20.0,
+                 max_retries: int = 2, hedge_after_seconds: float = 0.0, pool_size: int = 20,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, stream_usage: bool = True,
+                 total_timeout: float = 25.0):
+        # Um único httpx.Client para todos os serviços: as conexões keep-alive com o provedor são reaproveitadas
+        # entre chamadas e entre invocações de uma Lambda quente. Os retries são feitos aqui, não no SDK.
+        self.http_client = DefaultHttpxClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        self.client = OpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client, max_retries=0)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.hedge_after_seconds = hedge_after_seconds
+        self.pool_size = pool_size
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stream_usage = stream_usage
+        # Prazo da chamada inteira (tentativas + esperas): a Lambda tem 30 s e o API Gateway corta em 29 s.
+        self.total_timeout = total_timeout
+        self._lock = threading.Lock()
+        self._models = {}
+        self._recent = deque(maxlen=50)
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        # "Full jitter": espera aleatória até base * 2^tentativa, respeitando o Retry-After do provedor quando vier.
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(self.backoff_max, retry_after)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _attempt_timeout(self, deadline: float) -> httpx.Timeout:
+        # Cada tentativa só pode usar o que sobrou do prazo total.
+        remaining = max(0.1, deadline - time.perf_counter())
+        return httpx.Timeout(min(self.read_timeout, remaining), connect=min(self.connect_timeout, remaining))
+
+    def _wait_retry(self, model: str, attempt: int, error: Exception, deadline: float):
+        """Espera o backoff antes de repetir; se a espera não couber no prazo total, desiste com o erro da tentativa."""
+        delay = self._backoff(attempt, error)
+        if time.perf_counter() + delay >= deadline:
+            raise error
+        self._count(model, "retries")
+        time.sleep(delay)
+
+    def _model_stats(self, model: str) -> dict:
+        if model not in self._models:
+            self._models[model] = {
+                "calls": 0, "errors": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "hedge_wasted_tokens": 0,
+                "latencies": deque(maxlen=500),
+            }
+        return self._models[model]
+
+    def _count(self, model: str, name: str, value=1):
+        with self._lock:
+            self._model_stats(model)[name] += value
+
+    def _record(self, call: dict):
+        with self._lock:
+            stats = self._model_stats(call["model"])
+            stats["calls"] += 1
+            stats["errors"] += 0 if call["ok"] else 1
+            stats["prompt_tokens"] += call.get("prompt_tokens") or 0
+            stats["completion_tokens"] += call.get("completion_tokens") or 0
+            stats["latencies"].append(call["latency_ms"])
+            self._recent.append(call)
+
+    def _record_wasted(self, model: str, future):
+        # A chamada que perdeu o hedge não é cancelada no provedor; os tokens dela entram como custo extra.
+        if future.exception() is None and future.result().usage:
+            self._count(model, "hedge_wasted_tokens", future.result().usage.total_tokens or 0)
+
+    def _create(self, kwargs: dict):
+        return self.client.chat.completions.create(**kwargs)
+
+    def _create_hedged(self, kwargs: dict):
+        """Dispara uma segunda requisição igual se a primeira passar de hedge_after_seconds; vale a que terminar antes."""
+        if not self.hedge_after_seconds:
+            return self._create(kwargs), False
+        first = _HEDGE_POOL.submit(self._create, kwargs)
+        done, _ = wait([first], timeout=self.hedge_after_seconds)
+        if done:
+            return first.result(), False
+        second = _HEDGE_POOL.submit(self._create, kwargs)
+        self._count(kwargs["model"], "hedges")
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.add_done_callback(lambda f: self._record_wasted(kwargs["model"], f))
+                    if future is second:
+                        self._count(kwargs["model"], "hedge_wins")
+                    return future.result(), future is second
+                error = future.exception()
+        raise error
 
     def chat(self, model: str, system_msg: str, user_msg: str, response_format=None, temperature: float = 0.0):
+        kwargs = {
+            "model": model,
+            "temperature": temperature,
+            "messages": [
+                {"role": "system", "content": system_msg},
+                {"role": "user", "content": user_msg},
+            ],
+        }
+        if response_format:
+            kwargs["response_format"] = response_format
+        started = time.perf_counter()
+        deadline = started + self.total_timeout
+        call = {"model": model, "stream": False, "ok": False, "attempts": 0, "hedged": False}
         try:
-            kwargs = {}
-            if response_format:
-                kwargs["response_format"] = response_format
-            resp = self.client.chat.completions.create(
-                model=model,
-                temperature=temperature,
-                messages=[
-                    {"role": "system", "content": system_msg},
-                    {"role": "user", "content": user_msg},
-                ],
-                **kwargs
-            )
+            for attempt in range(self.max_retries + 1):
+                call["attempts"] = attempt + 1
+                kwargs["timeout"] = self._attempt_timeout(deadline)
+                try:
+                    resp, call["hedged"] = self._create_hedged(kwargs)
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries or not _retryable(e):
+                        raise
+                    self._wait_retry(model, attempt, e, deadline)
             content = resp.choices[0].message.content
-            return {"ok": True, "content": content}
+            usage = resp.usage
+            call.update(ok=True, response_model=resp.model,
+                        prompt_tokens=usage.prompt_tokens if usage else None,
+                        completion_tokens=usage.completion_tokens if usage else None)
+            return {"ok": True, "content": content, "usage": {"prompt_tokens": call["prompt_tokens"], "completion_tokens": call["completion_tokens"]}}
         except Exception as e:
+            call["error"] = f"{type(e).__name__}: {e}"[:300]
             return {"ok": False, "error": f"Erro ao chamar OpenAI: {str(e)}"}
+        finally:
+            call["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            self._record(call)
+
+
+    def chat_stream(self, model: str, system_msg: str, user_msg: str, temperature: float = 0.0):
+        # Sem hedging no streaming; o retry só acontece antes do primeiro token ter sido repassado.
+        kwargs = {
+            "model": model,
+            "temperature": temperature,
+            "messages": [
+                {"role": "system", "content": system_msg},
+                {"role": "user", "content": user_msg},
+            ],
+            "stream": True,
+        }
+        if self.stream_usage:
+            kwargs["stream_options"] = {"include_usage": True}
+        started = time.perf_counter()
+        deadline = started + self.total_timeout
+        call = {"model": model, "stream": True, "ok": False, "attempts": 0, "hedged": False}
+        sent = False
+        try:
+            for attempt in range(self.max_retries + 1):
+                call["attempts"] = attempt + 1
+                kwargs["timeout"] = self._attempt_timeout(deadline)
+                try:
+                    for chunk in self._create(kwargs):
+                        # O read timeout vale entre pedaços; um stream lento só é cortado pelo prazo total.
+                        if time.perf_counter() > deadline:
+                            raise TimeoutError(f"resposta excedeu o prazo total de {self.total_timeout:g} s")
+                        if chunk.usage:
+                            call.update(prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens)
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if not sent:
+                                call["first_token_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                                sent = True
+                            yield {"ok": True, "delta": chunk.choices[0].delta.content}
+                    break
+                except Exception as e:
+                    if sent or attempt == self.max_retries or not _retryable(e):
+                        raise
+                    self._wait_retry(model, attempt, e, deadline)
+            call["ok"] = True
+        except Exception as e:
+            call["error"] = f"{type(e).__name__}: {e}"[:300]
+            yield {"ok": False, "error": f"Erro ao chamar OpenAI: {str(e)}"}
+        finally:
+            call["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            self._record(call)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            models = {}
+            for model, stats in self._models.items():
+                data = {k: v for k, v in stats.items() if k != "latencies"}
+                latencies = list(stats["latencies"])
+                data.update(latency_p50_ms=_percentile(latencies, 0.5), latency_p95_ms=_percentile(latencies, 0.95),
+                            latency_p99_ms=_percentile(latencies, 0.99))
+                models[model] = data
+            recent = list(self._recent)[-10:]
+        return {
+            "connect_timeout": self.connect_timeout, "read_timeout": self.read_timeout, "total_timeout": self.total_timeout,
+            "max_retries": self.max_retries,
+            "hedge_after_seconds": self.hedge_after_seconds, "pool_size": self.pool_size,
+            "models": models, "recent": recent,
+        }
@@ -0,0 +1,131 @@
+import time, threading
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import pool
+
+# Pools ficam no módulo: numa Lambda "quente" o processo é reaproveitado e as conexões abertas
+# numa invocação servem as próximas sem novo handshake TCP/TLS/autenticação.
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class PoolBusy(pool.PoolError):
+    """Todas as conexões do pool ficaram ocupadas por mais que o tempo de espera."""
+
+
+class PgPool:
+    def __init__(self, conn_info: dict, max_size: int, health_check_seconds: float, wait_seconds: float = 5):
+        self.pool = pool.ThreadedConnectionPool(0, max_size, **conn_info)
+        self.max_size = max_size
+        self.health_check_seconds = health_check_seconds
+        self.wait_seconds = wait_seconds
+        # O ThreadedConnectionPool levanta PoolError na hora quando esgota; com o semáforo a thread espera uma conexão
+        # ser devolvida e só desiste depois de wait_seconds.
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self.metrics = {
+            "checkouts": 0,
+            "reused": 0,
+            "connections_created": 0,
+            "health_checks": 0,
+            "health_check_failures": 0,
+            "discarded": 0,
+            "reconnects": 0,
+            "in_use": 0,
+            "busy": 0,
+            "checkout_ms_total": 0.0,
+        }
+
+    def _count(self, name: str, value=1):
+        with self._lock:
+            self.metrics[name] += value
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        self.pool.putconn(conn, close=True)
+        self._count("discarded")
+
+    def _healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used[id(conn)] < self.health_check_seconds:
+            return True
+        self._count("health_checks")
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            self._count("health_check_failures")
+            return False
+
+    def _checkout(self):
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=self.wait_seconds):
+            self._count("busy")
+            raise PoolBusy(f"Banco ocupado: nenhuma conexão livre em {self.wait_seconds:g} s, tente novamente")
+        try:
+            while True:
+                conn = self.pool.getconn()
+                if id(conn) not in self._last_used:
+                    self._last_used[id(conn)] = time.monotonic()
+                    self._count("connections_created")
+                    break
+                if self._healthy(conn):
+                    self._count("reused")
+                    break
+                self._discard(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+        self._count("checkouts")
+        self._count("in_use")
+        self._count("checkout_ms_total", (time.perf_counter() - started) * 1000)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self._count("in_use", -1)
+            if conn.closed:
+                self._discard(conn)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self.pool.putconn(conn)
+            self._slots.release()
+
+    def run(self, fn):
+        """Executa fn(conn) com uma conexão do pool; se a conexão caiu no meio, tenta uma vez numa conexão nova."""
+        for attempt in (1, 2):
+            try:
+                with self.connection() as conn:
+                    return fn(conn)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if e.pgcode or attempt == 2:
+                    raise
+                self._count("reconnects")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self.metrics)
+        data["max_size"] = self.max_size
+        data["idle"] = len(self._last_used) - data["in_use"]
+        data["checkout_ms_avg"] = round(data.pop("checkout_ms_total") / data["checkouts"], 3) if data["checkouts"] else 0.0
+        return data
+
+
+def get_pool(conn_info: dict, max_size: int = 4, health_check_seconds: float = 30, wait_seconds: float = 5) -> PgPool:
+    key = tuple(sorted(conn_info.items()))
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = PgPool(conn_info, max_size, health_check_seconds, wait_seconds)
+        return _POOLS[key]
@@ -0,0 +1,131 @@
+import re, sqlparse
+
+SCHEMA = "tlc_trips"
+FATO = "ft_corrida_taxi"
+
+# Espelha ROLLUPS em extra/aws-cdk/lib/assets/dw_schema.py (mesma ordem: do menor para o maior).
+ROLLUPS = {
+    "rl_corrida_mes": {"dt_mes"},
+    "rl_corrida_pagamento": {"dt_mes", "cd_pagamento"},
+    "rl_corrida_hora": {"dt_mes", "nr_hora"},
+    "rl_corrida_zona": {"dt_mes", "cd_zona_embarque"},
+}
+
+FATO_COLUNAS = ["cd_empresa","qt_passageiros","vl_total","ts_inicio_corrida","ts_fim_corrida","vl_distancia_mi","cd_tarifa","fl_transmissao","cd_zona_embarque","cd_zona_desembarque","cd_pagamento","vl_tarifa_base","vl_extra","vl_mta_tax","vl_gorjeta","vl_pedagio","vl_sobretaxa_melhoria","vl_sobretaxa_congestionamento","vl_taxa_aeroporto"]
+MEDIDAS = [c for c in FATO_COLUNAS if c.startswith(("qt_", "vl_"))]
+CHAVES = {"cd_zona_embarque", "cd_pagamento"}
+
+_TS = r"ts_inicio_corrida"
+_MEDIDA = "|".join(MEDIDAS)
+
+# Expressões sobre ts_inicio_corrida que podem ser respondidas a partir de dt_mes (mês ou mais grosso) ou nr_hora.
+_EXPRESSOES = [
+    (rf"date_trunc\(\s*'month'\s*,\s*{_TS}\s*\)\s*::\s*date", lambda m: "dt_mes"),
+    (rf"date_trunc\(\s*'month'\s*,\s*{_TS}\s*\)", lambda m: "dt_mes::timestamp"),
+    (rf"date_trunc\(\s*'(year|quarter)'\s*,\s*{_TS}\s*\)", lambda m: f"date_trunc('{m[1].lower()}', dt_mes::timestamp)"),
+    (rf"extract\(\s*hour\s+from\s+{_TS}\s*\)", lambda m: "nr_hora"),
+    (rf"date_part\(\s*'hour'\s*,\s*{_TS}\s*\)", lambda m: "nr_hora"),
+    (rf"extract\(\s*(year|quarter|month)\s+from\s+{_TS}\s*\)", lambda m: f"extract({m[1].lower()} FROM dt_mes)"),
+    (rf"date_part\(\s*'(year|quarter|month)'\s*,\s*{_TS}\s*\)", lambda m: f"date_part('{m[1].lower()}', dt_mes)"),
+    (rf"to_char\(\s*{_TS}\s*,\s*'(YYYY-MM|YYYY|MM/YYYY|YYYY/MM|YYYYMM)'\s*\)", lambda m: f"to_char(dt_mes, '{m[1]}')"),
+]
+
+# Agregados sobre o fato e o equivalente re-agregado sobre o rollup.
+_AGREGADOS = [
+    (r"count\(\s*(?:\*|1)\s*\)", lambda m: "sum(qt_corridas)::bigint"),
+    (rf"count\(\s*({_MEDIDA})\s*\)", lambda m: f"sum(cont_{m[1].lower()})::bigint"),
+    (rf"sum\(\s*({_MEDIDA})\s*\)", lambda m: f"sum(soma_{m[1].lower()})"),
+    (rf"avg\(\s*({_MEDIDA})\s*\)", lambda m: f"(sum(soma_{m[1].lower()})::float8 / nullif(sum(cont_{m[1].lower()}), 0))"),
+]
+
+_OUTROS_AGREGADOS = re.compile(r"\b(count|sum|avg|min|max|stddev\w*|var\w*|percentile_\w+|mode|array_agg|string_agg|json\w*_agg|bool_\w+|every)\s*\(", re.I)
+_LITERAIS = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s")
+
+
+def _from_target(statement):
+    tokens = [tok for tok in statement.tokens if not tok.is_whitespace]
+    for i, tok in enumerate(tokens):
+        if tok.is_keyword and tok.normalized == "FROM":
+            target = tokens[i + 1] if i + 1 < len(tokens) else None
+            if isinstance(target, sqlparse.sql.Identifier) and target.get_real_name().lower() == FATO and (target.get_parent_name() or SCHEMA).lower() == SCHEMA:
+                return target
+            return None
+    return None
+
+
+def _unsupported(statement):
+    flat = list(statement.flatten())
+    if sum(1 for tok in flat if tok.ttype is sqlparse.tokens.DML and tok.normalized == "SELECT") != 1:
+        return True
+    keywords = {tok.normalized for tok in flat if tok.is_keyword}
+    return bool(keywords & {"DISTINCT", "OVER", "UNION", "INTERSECT", "EXCEPT", "WITH", "LATERAL"}) or any("JOIN" in k for k in keywords)
+
+
+def _keep_column_names(sql: str, trocas: list) -> str:
+    """Item do SELECT sem apelido que foi reescrito (count(*), avg(x)::numeric, date_trunc(...)::date) ganha AS com o
+    nome da função, que é o nome de coluna que o Postgres daria à consulta original; a reescrita viraria "sum",
+    "?column?" ou "dt_mes"."""
+    mascarado = _LITERAIS.sub(lambda m: " " * len(m[0]), sql)
+    profundidade, fim_select = 0, len(mascarado)
+    for m in re.finditer(r"[()]|\bfrom\b", mascarado, re.I):
+        if m[0] in "()":
+            profundidade += 1 if m[0] == "(" else -1
+        elif profundidade == 0:
+            fim_select = m.start()
+            break
+    for m in reversed(list(re.finditer(r"__troca(\d+)__", mascarado[:fim_select]))):
+        antes = mascarado[:m.start()].rstrip().lower()
+        depois = re.match(r"(\s*::\s*\w+(?:\s*\([\d\s,]*\))?)?\s*(?=,|$)", mascarado[m.end():fim_select])
+        if depois and (antes.endswith(",") or re.search(r"\bselect$", antes)):
+            fim = m.end() + len(depois[1] or "")
+            sql = f"{sql[:fim]} AS {trocas[int(m[1])][1]}{sql[fim:]}"
+    return sql
+
+
+def rewrite_to_rollup(sql_text: str):
+    """Reescreve um SELECT agregado sobre o fato para o menor rollup que o responde. Devolve (sql, rollup) ou (sql_text, None)."""
+    try:
+        statements = [s for s in sqlparse.parse(sql_text) if str(s).strip()]
+        if len(statements) != 1 or statements[0].get_type() != "SELECT" or _unsupported(statements[0]):
+            return sql_text, None
+        statement = statements[0]
+        target = _from_target(statement)
+        if target is None:
+            return sql_text, None
+
+        sql = "".join("__rollup__" if tok is target else str(tok) for tok in statement.tokens)
+        qualificadores = [rf"{SCHEMA}\.{FATO}", FATO] + ([re.escape(target.get_alias())] if target.get_alias() else [])
+        sql = re.sub(rf"\b(?:{'|'.join(qualificadores)})\.(\w+)", r"\1", sql, flags=re.I)
+        if re.search(r"(?:select|,)\s*\*", sql, re.I):
+            return sql_text, None
+
+        # Expressões de tempo e agregados viram marcadores até o fim, para que as trocas não sejam lidas como colunas ou agregados.
+        trocas = []
+        for pattern, repl in _EXPRESSOES + _AGREGADOS:
+            def guardar(m, repl=repl):
+                trocas.append((repl(m), re.match(r"\w+", m[0])[0].lower()))
+                return f"__troca{len(trocas) - 1}__"
+            sql = re.sub(pattern, guardar, sql, flags=re.I)
+        agregados = [nome for _, nome in trocas if nome in ("count", "sum", "avg")]
+        restaurada = re.sub(r"__troca(\d+)__", lambda m: trocas[int(m[1])][0], sql)
+        if _OUTROS_AGREGADOS.search(sql):
+            return sql_text, None
+        if not agregados and not re.search(r"\bgroup\s+by\b", sql, re.I):
+            return sql_text, None
+
+        sem_literais = _LITERAIS.sub(" ", restaurada)
+        # Apelidos de saída (AS vl_total) não são colunas; se forem usados como coluna, o rollup não as tem e o Postgres recusa.
+        apelidos = {a.lower() for a in re.findall(r"\bas\s+(\w+)", sem_literais, re.I)}
+        identificadores = {i.lower() for i in re.findall(r"\b[a-zA-Z_]\w*\b", sem_literais)} - apelidos
+        if identificadores & (set(FATO_COLUNAS) - CHAVES):
+            return sql_text, None
+        necessarias = {"dt_mes"} | (identificadores & (CHAVES | {"nr_hora"}))
+        rollup = next((nome for nome, chaves in ROLLUPS.items() if necessarias <= chaves), None)
+        if rollup is None:
+            return sql_text, None
+
+        sql = _keep_column_names(sql, trocas)
+        sql = re.sub(r"__troca(\d+)__", lambda m: trocas[int(m[1])][0], sql)
+        return sql.replace("__rollup__", f"{SCHEMA}.{rollup}"), rollup
+    except Exception:
+        return sql_text, None
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Os serviços são importados como no app.py (from services...), a partir da raiz do backend.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,31 @@
+import pytest
+from services.db_qa import ALLOWED
+from services.intent_rules import LocalIntentRules
+
+DOCS = ["company-files/Politica de Reembolso.pdf", "company-files/Historia da Frota.docx"]
+
+
+@pytest.fixture
+def rules():
+    return LocalIntentRules(ALLOWED, lambda: DOCS)
+
+
+@pytest.mark.parametrize("question, intent", [
+    ("Quantas corridas de táxi tiveram gorjeta acima de 10 dólares?", "db"),
+    ("Qual a média de gorjetas por zona de embarque?", "db"),
+    ("O que diz a política de reembolso?", "docs"),
+    ("Oi, bom dia!", "generic"),
+])
+def test_decides_with_domain_terms(rules, question, intent):
+    assert rules.decide(question)[0] == intent
+
+
+@pytest.mark.parametrize("question", [
+    "Qual o maior rio do Brasil?",
+    "Qual o total de habitantes de São Paulo?",
+    "Qual a média de idade dos brasileiros de acordo com o IBGE?",
+    "Qual a gorjeta?",
+    "Oi",
+])
+def test_common_words_go_to_the_llm(rules, question):
+    assert rules.decide(question)[0] is None
@@ -0,0 +1,79 @@
+import pytest
+from services.db_qa import _clamp_limit
+from services.rollup_rewriter import rewrite_to_rollup
+
+FATO = "tlc_trips.ft_corrida_taxi"
+
+
+@pytest.mark.parametrize("sql, rollup", [
+    (f"SELECT date_trunc('month', ts_inicio_corrida)::date AS mes, count(*) AS qt FROM {FATO} GROUP BY 1", "rl_corrida_mes"),
+    (f"SELECT extract(year FROM ts_inicio_corrida) AS ano, sum(vl_total) AS total FROM {FATO} GROUP BY 1", "rl_corrida_mes"),
+    (f"SELECT date_trunc('quarter', ts_inicio_corrida) AS tri, avg(vl_gorjeta) AS media FROM {FATO} GROUP BY 1", "rl_corrida_mes"),
+    (f"SELECT extract(hour FROM ts_inicio_corrida) AS hora, count(*) AS qt FROM {FATO} GROUP BY 1", "rl_corrida_hora"),
+    (f"SELECT f.cd_zona_embarque, count(*) AS qt FROM {FATO} f GROUP BY 1 ORDER BY 2 DESC LIMIT 10", "rl_corrida_zona"),
+    (f"SELECT cd_pagamento, avg(vl_gorjeta) AS media FROM {FATO} GROUP BY cd_pagamento", "rl_corrida_pagamento"),
+])
+def test_rewrite_picks_smallest_rollup(sql, rollup):
+    rewritten, used = rewrite_to_rollup(sql)
+    assert used == rollup
+    assert f"tlc_trips.{rollup}" in rewritten
+    assert "ts_inicio_corrida" not in rewritten
+
+
+def test_rewrite_reaggregates_measures():
+    rewritten, _ = rewrite_to_rollup(f"SELECT cd_pagamento, count(*) AS qt, count(vl_total) AS n, sum(vl_total) AS total, avg(vl_total) AS media FROM {FATO} GROUP BY 1")
+    assert "sum(qt_corridas)::bigint AS qt" in rewritten
+    assert "sum(cont_vl_total)::bigint AS n" in rewritten
+    assert "sum(soma_vl_total) AS total" in rewritten
+    assert "(sum(soma_vl_total)::float8 / nullif(sum(cont_vl_total), 0)) AS media" in rewritten
+
+
+@pytest.mark.parametrize("item, alias", [
+    ("count(*)", "count"),
+    ("sum(vl_total)", "sum"),
+    ("avg(vl_total)", "avg"),
+    ("avg(vl_total)::numeric(10,2)", "avg"),
+    ("date_trunc('month', ts_inicio_corrida)::date", "date_trunc"),
+])
+def test_rewrite_keeps_default_column_names(item, alias):
+    rewritten, used = rewrite_to_rollup(f"SELECT {item}, cd_pagamento FROM {FATO} GROUP BY cd_pagamento, date_trunc('month', ts_inicio_corrida)::date")
+    assert used is not None
+    assert f" AS {alias}, cd_pagamento" in rewritten
+
+
+def test_rewrite_does_not_alias_inside_expressions_or_order_by():
+    rewritten, _ = rewrite_to_rollup(f"SELECT cd_pagamento, count(*) * 2 AS dobro, round(avg(vl_gorjeta), 2) AS media FROM {FATO} GROUP BY 1 HAVING count(*) > 10 ORDER BY count(*) DESC")
+    assert rewritten.count(" AS ") == 2
+    assert "HAVING sum(qt_corridas)::bigint > 10 ORDER BY sum(qt_corridas)::bigint DESC" in rewritten
+
+
+@pytest.mark.parametrize("sql", [
+    f"SELECT e.ds_empresa, count(*) FROM {FATO} f JOIN tlc_trips.dim_empresa e ON e.cd_empresa = f.cd_empresa GROUP BY 1",
+    f"SELECT count(*) FROM (SELECT * FROM {FATO}) t",
+    f"SELECT count(DISTINCT cd_pagamento) FROM {FATO}",
+    f"SELECT cd_pagamento, count(*) OVER (PARTITION BY cd_pagamento) FROM {FATO}",
+    f"SELECT max(vl_total) FROM {FATO}",
+    f"SELECT cd_empresa, count(*) FROM {FATO} GROUP BY 1",
+    f"SELECT date_trunc('day', ts_inicio_corrida), count(*) FROM {FATO} GROUP BY 1",
+    f"SELECT count(*) FROM {FATO} WHERE vl_total > 10",
+    f"SELECT * FROM {FATO} LIMIT 10",
+    "SELECT count(*) FROM tlc_trips.dim_zona",
+])
+def test_rewrite_leaves_unsupported_queries_alone(sql):
+    assert rewrite_to_rollup(sql) == (sql, None)
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT a FROM t LIMIT 500", "SELECT a FROM t LIMIT 100"),
+    ("SELECT a FROM t LIMIT 10", "SELECT a FROM t LIMIT 10"),
+    ("SELECT a FROM t LIMIT ALL", "SELECT a FROM t LIMIT 100"),
+    ("SELECT a FROM t LIMIT %(p1)s", "SELECT a FROM t LIMIT LEAST(%(p1)s, 100)"),
+    ("SELECT a FROM t", "SELECT a FROM t LIMIT 100"),
+    ("SELECT a FROM t;", "SELECT a FROM t LIMIT 100"),
+    ("SELECT a FROM t -- comentário\n", "SELECT a FROM t LIMIT 100"),
+    ("SELECT a FROM t LIMIT 500 OFFSET 20", "SELECT a FROM t LIMIT 100 OFFSET 20"),
+    ("SELECT a FROM (SELECT a FROM t LIMIT 500) s", "SELECT a FROM (SELECT a FROM t LIMIT 500) s LIMIT 100"),
+    ("SELECT a FROM t FETCH FIRST 500 ROWS ONLY", "SELECT * FROM (SELECT a FROM t FETCH FIRST 500 ROWS ONLY) AS limitado LIMIT 100"),
+])
+def test_clamp_limit(sql, expected):
+    assert _clamp_limit(sql, 100) == expected
@@ -17,6 +17,20 @@ secret_keys = [
     'PROJECT_NAME', 'PROJECT_OWNER', 'BUCKET_NAME', 'POSTGRES_HOST', 
     'POSTGRES_PORT', 'POSTGRES_DB', 'POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_SCHEMA', 'MODEL_CLASSIFIER', 'MODEL_DB', 'MODEL_DOCS', 
     'MODEL_GENERIC', 'COMPANY_FILES_PREFIX', 'MAX_RESULT_ROWS', 'OPENAI_API_KEY', 'OPENAI_BASE_URL', 
+    'LANDING_MODE', 'LANDING_CHUNK_MB', 'LANDING_WORKERS', 'LANDING_RETRIES', 'LANDING_INCREMENTAL',
+    'TRUSTED_INCREMENTAL', 'PARQUET_ROW_GROUP_MB', 'REFINED_STORAGE_LEVEL',
+    'REFINED_WRITE_WORKERS', 'REFINED_FORMAT', 'REFINED_VACUUM_INTERVAL_DAYS', 'REFINED_VACUUM_RETAIN_HOURS',
+    'DW_LOAD_METHOD', 'DW_COPY_WRITERS', 'DW_COPY_BATCH_ROWS', 'DW_LOAD_WORKERS', 'DW_LOAD_MODE',
+    'DB_ROLLUP_REWRITE', 'POSTGRES_POOL_MAX', 'POSTGRES_POOL_HEALTHCHECK_SECONDS', 'POSTGRES_POOL_WAIT_SECONDS',
+    'POSTGRES_CONNECT_TIMEOUT', 'DB_STATEMENT_TIMEOUT_MS', 'REDIS_URL', 'CACHE_MAX_ENTRIES',
+    'CACHE_TTL_INTENT', 'CACHE_TTL_SQL', 'CACHE_TTL_RESULT',
+    'DW_VERSION_CHECK_SECONDS', 'CLASSIFIER_LOCAL', 'CLASSIFIER_RULES_PATH', 'CLASSIFIER_SHADOW_RATE',
+    'DOCS_CACHE_MAX_MB', 'DOCS_CACHE_DIR', 'DOCS_CACHE_DISK_MAX_MB', 'DOCS_LISTING_TTL_SECONDS',
+    'DOCS_RETRIEVAL', 'DOCS_TOP_K', 'DOCS_CHUNK_WORDS', 'DOCS_INDEX_PATH',
+    'DOCS_FETCH_WORKERS', 'DOCS_PARSE_PROCESSES',
+    'DOCS_REFRESH_MODE', 'DOCS_REFRESH_SECONDS', 'DOCS_SNAPSHOT_PATH',
+    'OPENAI_CONNECT_TIMEOUT', 'OPENAI_READ_TIMEOUT', 'OPENAI_TOTAL_TIMEOUT', 'OPENAI_MAX_RETRIES',
+    'OPENAI_HEDGE_AFTER_SECONDS', 'OPENAI_POOL_SIZE', 'OPENAI_STREAM_USAGE',
 ]
 
 app_env_payload = {k: os.environ[k] for k in secret_keys if os.environ.get(k)}
@@ -41,6 +55,15 @@ crawler_specs = [
     {"key":"refined","name":f"{project}-refined-crawler","database_name":f"{base}_refined_db","s3_path":f"s3://{bucket}/refined-zone/"}
 ]
 
+refined_tables = ["dim_empresa", "dim_tarifa", "dim_pagamento", "dim_transmissao", "dim_zona", "dim_calendario", "ft_corrida_taxi"]
+delta_args = {}
+if os.environ.get("REFINED_FORMAT") == "delta":
+    crawler_specs[2]["delta_tables"] = [f"s3://{bucket}/refined-zone/{table}/" for table in refined_tables]
+    delta_args = {
+        "--datalake-formats": "delta",
+        "--conf": "spark.sql.extensions=io.delta.sql.DeltaSparkSessionExtension --conf spark.sql.catalog.spark_catalog=org.apache.spark.sql.delta.catalog.DeltaCatalog",
+    }
+
 glue_crawler_stack = GlueCrawlers(app, id="GlueCrawlerStack", env=env, role_arn=iam_stack.role.role_arn, crawlers=crawler_specs, s3_bucket=s3_stack.s3_bucket, iam_role=iam_stack.role)
 
 landing_crawler = glue_crawler_stack.crawlers["landing"]
@@ -64,17 +87,22 @@ landing_job = GlueJobStack(app, id="LandingJobStack", env=env, s3_bucket=s3_stac
 trusted_job = GlueJobStack(app, id="TrustedJobStack", env=env, s3_bucket=s3_stack.s3_bucket, iam_role=iam_stack.role, job_name=f"{project}-trusted-job", script_location=f"s3://{bucket}/glue-scripts/trusted_zone.py", 
     new_args={
         "--base_path": f"s3://{bucket}",
+        "--extra-py-files": f"s3://{bucket}/glue-scripts/reference_data.py",
         "--app_env_secret_name": secrets_stack.app_env_secret.secret_name,  
     }
 )
 refined_job = GlueJobStack(app, id="RefinedJobStack", env=env, s3_bucket=s3_stack.s3_bucket, iam_role=iam_stack.role, job_name=f"{project}-refined-job", script_location=f"s3://{bucket}/glue-scripts/refined_zone.py", 
     new_args={
+        **delta_args,
         "--base_path": f"s3://{bucket}",
+        "--extra-py-files": f"s3://{bucket}/glue-scripts/reference_data.py,s3://{bucket}/glue-scripts/surrogate_keys.py",
         "--app_env_secret_name": secrets_stack.app_env_secret.secret_name,  
     }
 )
 refined_to_dw_job = GlueJobStack(app, id="RefinedDwJobStack", env=env, s3_bucket=s3_stack.s3_bucket, iam_role=iam_stack.role, job_name=f"{project}-refined-dw-job", script_location=f"s3://{bucket}/glue-scripts/refined_to_dw.py", 
     new_args={
+        **delta_args,
+        "--extra-py-files": f"s3://{bucket}/glue-scripts/dw_schema.py",
         "--base_path": f"s3://{bucket}",
         "--app_env_secret_name": secrets_stack.app_env_secret.secret_name,  
     }
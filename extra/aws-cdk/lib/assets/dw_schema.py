@@ -0,0 +1,150 @@
+FATO = "ft_corrida_taxi"
+
+FATO_COLUNAS = [
+    ("cd_empresa", "integer"),
+    ("qt_passageiros", "integer"),
+    ("vl_total", "real"),
+    ("ts_inicio_corrida", "timestamp"),
+    ("ts_fim_corrida", "timestamp"),
+    ("vl_distancia_mi", "real"),
+    ("cd_tarifa", "integer"),
+    ("fl_transmissao", "text"),
+    ("cd_zona_embarque", "integer"),
+    ("cd_zona_desembarque", "integer"),
+    ("cd_pagamento", "integer"),
+    ("vl_tarifa_base", "real"),
+    ("vl_extra", "real"),
+    ("vl_mta_tax", "real"),
+    ("vl_gorjeta", "real"),
+    ("vl_pedagio", "real"),
+    ("vl_sobretaxa_melhoria", "real"),
+    ("vl_sobretaxa_congestionamento", "real"),
+    ("vl_taxa_aeroporto", "real"),
+]
+
+MEDIDAS = [nome for nome, tipo in FATO_COLUNAS if nome.startswith(("qt_", "vl_"))]
+# sum(real) acumula em float4 e perde precisão em milhões de linhas; nos rollups as somas dessas medidas são float8.
+MEDIDAS_REAL = {nome for nome, tipo in FATO_COLUNAS if tipo == "real"}
+
+ROLLUPS = {
+    "rl_corrida_mes": [
+        ("dt_mes", "date_trunc('month', ts_inicio_corrida)::date"),
+    ],
+    "rl_corrida_hora": [
+        ("dt_mes", "date_trunc('month', ts_inicio_corrida)::date"),
+        ("nr_hora", "extract(hour FROM ts_inicio_corrida)::integer"),
+    ],
+    "rl_corrida_zona": [
+        ("dt_mes", "date_trunc('month', ts_inicio_corrida)::date"),
+        ("cd_zona_embarque", "cd_zona_embarque"),
+    ],
+    "rl_corrida_pagamento": [
+        ("dt_mes", "date_trunc('month', ts_inicio_corrida)::date"),
+        ("cd_pagamento", "cd_pagamento"),
+    ],
+}
+
+
+def _rollup_sql(schema, nome, chaves):
+    colunas = [f"{expr} AS {alias}" for alias, expr in chaves] + ["count(*) AS qt_corridas"]
+    for medida in MEDIDAS:
+        soma = f"{medida}::float8" if medida in MEDIDAS_REAL else medida
+        colunas += [f"sum({soma}) AS soma_{medida}", f"count({medida}) AS cont_{medida}"]
+    grupos = ", ".join(str(i + 1) for i in range(len(chaves)))
+    return [
+        f"CREATE MATERIALIZED VIEW IF NOT EXISTS {schema}.{nome} AS SELECT {', '.join(colunas)} FROM {schema}.{FATO} GROUP BY {grupos}",
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {nome}_pk ON {schema}.{nome} ({', '.join(alias for alias, _ in chaves)})",
+    ]
+
+
+def _partitioned_fact(schema):
+    colunas = ", ".join(f"{nome} {tipo}" for nome, tipo in FATO_COLUNAS)
+    return [
+        f"""
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = '{schema}' AND c.relname = '{FATO}' AND c.relkind = 'r'
+            ) THEN
+                ALTER TABLE {schema}.{FATO} RENAME TO {FATO}_legacy;
+            END IF;
+        END $$
+        """,
+        f"CREATE TABLE IF NOT EXISTS {schema}.{FATO} ({colunas}) PARTITION BY RANGE (ts_inicio_corrida)",
+    ]
+
+
+FATO_INDICES = [
+    ("ts_inicio_brin", "brin", "ts_inicio_corrida"),
+    ("ts_fim_brin", "brin", "ts_fim_corrida"),
+    ("zona_embarque_idx", "btree", "cd_zona_embarque"),
+    ("zona_desembarque_idx", "btree", "cd_zona_desembarque"),
+    ("pagamento_idx", "btree", "cd_pagamento"),
+]
+
+
+def _fact_indexes(schema):
+    return [f"CREATE INDEX IF NOT EXISTS {FATO}_{nome} ON {schema}.{FATO} USING {metodo} ({coluna})" for nome, metodo, coluna in FATO_INDICES]
+
+
+def partition_indexes(tabela):
+    # Mesmos índices do fato numa tabela avulsa (staging de um mês): no ATTACH PARTITION o Postgres aproveita
+    # índices equivalentes em vez de construí-los. Nomes gerados pelo Postgres, para não colidir entre cargas.
+    return [f"CREATE INDEX ON {tabela} USING {metodo} ({coluna})" for _, metodo, coluna in FATO_INDICES]
+
+
+def _rollups(schema):
+    return [sql for nome, chaves in ROLLUPS.items() for sql in _rollup_sql(schema, nome, chaves)]
+
+
+def _load_control(schema):
+    return [
+        f"CREATE TABLE IF NOT EXISTS {schema}.dw_carga (carregado_em timestamp PRIMARY KEY DEFAULT now(), modo text NOT NULL)",
+    ]
+
+
+MIGRATIONS = [
+    ("001_fato_particionado", _partitioned_fact),
+    ("002_indices_fato", _fact_indexes),
+    ("003_rollups", _rollups),
+    ("004_controle_carga", _load_control),
+]
+
+
+def migrate(conn, schema):
+    with conn, conn.cursor() as cur:
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {schema}.schema_migrations (versao text PRIMARY KEY, aplicada_em timestamp NOT NULL DEFAULT now())")
+        cur.execute(f"SELECT versao FROM {schema}.schema_migrations")
+        aplicadas = {row[0] for row in cur.fetchall()}
+    novas = []
+    for versao, statements in MIGRATIONS:
+        if versao in aplicadas:
+            continue
+        with conn, conn.cursor() as cur:
+            for sql in statements(schema):
+                cur.execute(sql)
+            cur.execute(f"INSERT INTO {schema}.schema_migrations (versao) VALUES (%s)", (versao,))
+        novas.append(versao)
+    return novas
+
+
+def ensure_month_partition(cur, schema, inicio, fim):
+    cur.execute(
+        f"CREATE TABLE IF NOT EXISTS {schema}.{FATO}_{inicio:%Y%m} PARTITION OF {schema}.{FATO} FOR VALUES FROM ('{inicio}') TO ('{fim}')"
+    )
+
+
+def refresh_rollups(conn, schema):
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for nome in ROLLUPS:
+                cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {schema}.{nome}")
+    finally:
+        conn.autocommit = False
+
+
+def record_load(conn, schema, modo):
+    with conn, conn.cursor() as cur:
+        cur.execute(f"INSERT INTO {schema}.dw_carga (modo) VALUES (%s)", (modo,))
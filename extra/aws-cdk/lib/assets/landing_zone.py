@@ -1,11 +1,19 @@
 import os
 import sys
 import json
+import time
+import hashlib
+import resource
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+import pyarrow.parquet as pq
 from io import BytesIO
 import boto3
+from botocore.config import Config
 from awsglue.utils import getResolvedOptions
 
 args = getResolvedOptions(sys.argv, ["base_path", "app_env_secret_name"])
@@ -19,33 +27,171 @@ cfg = json.loads(secret_value["SecretString"])
 bucket_name = cfg["BUCKET_NAME"]
 year = cfg.get("YEAR", "2023")
 months = cfg.get("MONTHS", ["01","02","03","04","05"])
+landing_mode = cfg.get("LANDING_MODE", "convert")
+# O S3 recusa partes de multipart menores que 5 MB (exceto a última).
+chunk_size = max(5, int(cfg.get("LANDING_CHUNK_MB", 8))) * 1024 * 1024
+# No convert cada mês inteiro passa pelo pandas (vários GB por arquivo); em paralelo só por escolha explícita.
+workers = int(cfg.get("LANDING_WORKERS", 1 if landing_mode == "convert" else 4))
+max_retries = int(cfg.get("LANDING_RETRIES", 3))
+incremental = str(cfg.get("LANDING_INCREMENTAL", "false")).lower() == "true"
 
 ingest_dt = datetime.utcnow()
 ingest_year = f"{ingest_dt.year:04d}"
 ingest_month = f"{ingest_dt.month:02d}"
 ingest_day = f"{ingest_dt.day:02d}"
 
-s3 = boto3.client("s3")
+retry = Retry(total=max_retries, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET", "HEAD"])
+http = req.Session()
+http.mount("https://", HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry))
 
+s3 = boto3.client("s3", config=Config(max_pool_connections=max(workers * 2, 10), retries={"max_attempts": max_retries + 1, "mode": "standard"}))
+
+
+manifest_key = f"{base_path}/manifests/landing_zone.json"
+
+
+def load_manifest():
+    try:
+        return json.loads(s3.get_object(Bucket=bucket_name, Key=manifest_key)["Body"].read())
+    except s3.exceptions.NoSuchKey:
+        return {}
+
+
+manifest = load_manifest()
+known = manifest if incremental else {}
+
+
+def conditional_headers(url):
+    previous = known.get(url, {})
+    headers = {}
+    if previous.get("etag"):
+        headers["If-None-Match"] = previous["etag"]
+    if previous.get("last_modified"):
+        headers["If-Modified-Since"] = previous["last_modified"]
+    return headers
+
+
+def manifest_entry(url, s3_key, resp, size, sha256):
+    return {
+        "url": url,
+        "s3_key": s3_key,
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "size": size,
+        "sha256": sha256,
+        "landed_at": ingest_dt.isoformat(),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss é o pico do processo inteiro desde o início (high-water mark), não o consumo de um arquivo.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def stream_to_s3(url, s3_key):
+    started = time.perf_counter()
+    parts = []
+    total_bytes = 0
+    digest = hashlib.sha256()
+
+    with http.get(url, stream=True, timeout=60, headers=conditional_headers(url)) as resp:
+        if resp.status_code == 304:
+            return None
+        resp.raise_for_status()
+        upload_id = s3.create_multipart_upload(Bucket=bucket_name, Key=s3_key)["UploadId"]
+
+        def upload_part(body):
+            part_number = len(parts) + 1
+            part = s3.upload_part(Bucket=bucket_name, Key=s3_key, UploadId=upload_id, PartNumber=part_number, Body=body)
+            parts.append({"PartNumber": part_number, "ETag": part["ETag"]})
+
+        try:
+            pending = bytearray()
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                pending.extend(chunk)
+                digest.update(chunk)
+                total_bytes += len(chunk)
+                if len(pending) >= chunk_size:
+                    upload_part(bytes(pending))
+                    pending = bytearray()
+            if pending or not parts:
+                upload_part(bytes(pending))
+            s3.complete_multipart_upload(Bucket=bucket_name, Key=s3_key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+        except Exception:
+            s3.abort_multipart_upload(Bucket=bucket_name, Key=s3_key, UploadId=upload_id)
+            raise
+
+    elapsed = time.perf_counter() - started
+    mb_per_sec = (total_bytes / 1024 / 1024) / elapsed if elapsed else 0.0
+    print(f"{s3_key}: {total_bytes} bytes in {elapsed:.1f}s ({mb_per_sec:.1f} MB/s)")
+    return manifest_entry(url, s3_key, resp, total_bytes, digest.hexdigest())
+
+
+def land(url, s3_key, kind):
+    if landing_mode == "stream":
+        entry = stream_to_s3(url, s3_key)
+        return entry, entry is not None
+    resp = http.get(url, timeout=60, headers=conditional_headers(url))
+    if resp.status_code == 304:
+        return None, False
+    resp.raise_for_status()
+    entry = manifest_entry(url, s3_key, resp, len(resp.content), hashlib.sha256(resp.content).hexdigest())
+    previous = known.get(url)
+    if previous and previous.get("sha256") == entry["sha256"]:
+        return {**entry, "s3_key": previous["s3_key"], "landed_at": previous["landed_at"]}, False
+    if landing_mode == "passthrough":
+        body = resp.content
+        if kind == "parquet":
+            metadata = pq.read_metadata(BytesIO(resp.content))
+            print(f"{s3_key}: {metadata.num_rows} rows, {metadata.num_row_groups} row groups, native schema")
+    else:
+        buf = BytesIO()
+        if kind == "parquet":
+            pd.read_parquet(BytesIO(resp.content)).astype(str).to_parquet(buf, index=False)
+        else:
+            pd.read_csv(BytesIO(resp.content)).astype(str).to_csv(buf, index=False)
+        body = buf.getvalue()
+    s3.put_object(Body=body, Bucket=bucket_name, Key=s3_key)
+    return entry, True
+
+
+def timed_land(url, s3_key, kind):
+    started = time.perf_counter()
+    entry, landed = land(url, s3_key, kind)
+    return entry, landed, time.perf_counter() - started
+
+
+tasks = {}
 for month in months:
     url = f"https://d37ci6vzurychx.cloudfront.net/trip-data/yellow_tripdata_{year}-{month}.parquet"
-    resp = req.get(url, timeout=60)
-    resp.raise_for_status()
-    df = pd.read_parquet(BytesIO(resp.content)).astype(str)
-    buf = BytesIO()
-    df.to_parquet(buf, index=False)
-    buf.seek(0)
     s3_key = f"{base_path}/landing-zone/yellow_tripdata/year={ingest_year}/month={ingest_month}/day={ingest_day}/yellow_tripdata_{year}-{month}.parquet"
-    s3.put_object(Body=buf, Bucket=bucket_name, Key=s3_key)
-    print(f"{year}-{month} -> s3://{bucket_name}/{s3_key}")
+    tasks[f"{year}-{month}"] = (url, s3_key, "parquet")
 
 url_lookup = "https://d37ci6vzurychx.cloudfront.net/misc/taxi_zone_lookup.csv"
-resp_lookup = req.get(url_lookup, timeout=60)
-resp_lookup.raise_for_status()
-df_lookup = pd.read_csv(BytesIO(resp_lookup.content)).astype(str)
-buf = BytesIO()
-df_lookup.to_csv(buf, index=False)
-buf.seek(0)
 s3_key_lookup = f"{base_path}/landing-zone/taxi_zone/year={ingest_year}/month={ingest_month}/day={ingest_day}/taxi_zone_lookup.csv"
-s3.put_object(Body=buf, Bucket=bucket_name, Key=s3_key_lookup)
-print(f"lookup -> s3://{bucket_name}/{s3_key_lookup}")
+tasks["lookup"] = (url_lookup, s3_key_lookup, "csv")
+
+run_started = time.perf_counter()
+failed = []
+with ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = {pool.submit(timed_land, *task): label for label, task in tasks.items()}
+    for future in as_completed(futures):
+        label = futures[future]
+        url, s3_key, _ = tasks[label]
+        try:
+            entry, landed, elapsed = future.result()
+        except Exception as e:
+            failed.append(label)
+            print(f"{label} failed: {e}")
+            continue
+        if entry:
+            manifest[url] = entry
+        if landed:
+            print(f"{label} -> s3://{bucket_name}/{s3_key} in {elapsed:.1f}s")
+        else:
+            print(f"{label} unchanged at source, skipped in {elapsed:.1f}s")
+print(f"{len(tasks)} files with {workers} workers in {time.perf_counter() - run_started:.1f}s, process peak RSS (high-water mark) {peak_rss_mb():.0f} MB")
+
+s3.put_object(Body=json.dumps(manifest, indent=2).encode("utf-8"), Bucket=bucket_name, Key=manifest_key, ContentType="application/json")
+if failed:
+    raise RuntimeError(f"Landing failed for: {', '.join(sorted(failed))}")
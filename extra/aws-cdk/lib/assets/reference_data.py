@@ -0,0 +1,56 @@
+from pyspark.sql import types as t
+
+REFERENCE_VERSION = "2023.1"
+
+BLANK = "Blank"
+
+EMPRESA = {
+    1: "Creative Mobile Technologies, LLC",
+    2: "Curb Mobility, LLC",
+    6: "Myle Technologies Inc",
+    7: "Helix",
+}
+
+TARIFA = {
+    1: "Standard rate",
+    2: "JFK",
+    3: "Newark",
+    4: "Nassau or Westchester",
+    5: "Negotiated fare",
+    6: "Group ride",
+    99: "Null/unknown",
+}
+
+PAGAMENTO = {
+    0: "Flex Fare trip",
+    1: "Credit card",
+    2: "Cash",
+    3: "No charge",
+    4: "Dispute",
+    5: "Unknown",
+    6: "Voided trip",
+}
+
+TRANSMISSAO = {
+    "Y": "Store and forward trip",
+    "N": "Not a store and forward trip",
+}
+
+REFERENCES = {
+    "empresa": ("cd_empresa", "ds_empresa", t.IntegerType(), EMPRESA),
+    "tarifa": ("cd_tarifa", "ds_tarifa", t.IntegerType(), TARIFA),
+    "pagamento": ("cd_pagamento", "ds_pagamento", t.IntegerType(), PAGAMENTO),
+    "transmissao": ("fl_transmissao", "ds_transmissao", t.StringType(), TRANSMISSAO),
+}
+
+
+def reference_df(spark, name, include_blank=False):
+    code_col, desc_col, code_type, labels = REFERENCES[name]
+    rows = sorted(labels.items())
+    if include_blank:
+        rows = [(None, BLANK)] + rows
+    schema = t.StructType([
+        t.StructField(code_col, code_type, True),
+        t.StructField(desc_col, t.StringType(), False),
+    ])
+    return spark.createDataFrame(rows, schema)
@@ -1,12 +1,18 @@
 import os
 import sys
 import json
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import boto3
+import psycopg2
 from awsglue.utils import getResolvedOptions
-from pyspark.sql import SparkSession
+from pyspark.sql import SparkSession, functions as f
+import dw_schema
 
 args = getResolvedOptions(sys.argv, ["base_path", "app_env_secret_name"])
 base_path = args["base_path"].rstrip("/")
+lake_path = base_path
 secret_name = args["app_env_secret_name"]
 
 if base_path.startswith("s3://"):
@@ -17,12 +23,22 @@ if not base_path.endswith("/refined-zone"):
 sm = boto3.client("secretsmanager", region_name=os.environ.get("AWS_REGION", "us-east-1"))
 cfg = json.loads(sm.get_secret_value(SecretId=secret_name)["SecretString"])
 
+bucket = cfg["BUCKET_NAME"]
 host = cfg["POSTGRES_HOST"]
 port = str(cfg.get("POSTGRES_PORT"))
 db = cfg["POSTGRES_DB"]
 user = cfg["POSTGRES_USER"]
 pwd = cfg["POSTGRES_PASSWORD"]
 schema = cfg.get("POSTGRES_SCHEMA")
+refined_format = cfg.get("REFINED_FORMAT", "parquet")
+load_method = cfg.get("DW_LOAD_METHOD", "jdbc")
+copy_writers = int(cfg.get("DW_COPY_WRITERS", 8))
+copy_batch_rows = int(cfg.get("DW_COPY_BATCH_ROWS", 100000))
+load_mode = cfg.get("DW_LOAD_MODE", "full")
+load_workers = int(cfg.get("DW_LOAD_WORKERS", 4)) if load_method == "copy" or load_mode == "incremental" else 1
+run_started_at = datetime.utcnow()
+
+s3 = boto3.client("s3")
 
 spark = SparkSession.builder.appName("RefinedToDW").getOrCreate()
 spark._jsc.hadoopConfiguration().set(
@@ -32,13 +48,246 @@ spark._jsc.hadoopConfiguration().set(
 
 jdbc_url = f"jdbc:postgresql://{host}:{port}/{db}"
 props = {"user": user, "password": pwd, "driver": "org.postgresql.Driver"}
+pg_conn_info = dict(host=host, port=int(port), dbname=db, user=user, password=pwd)
 
 dimensoes = ["dim_empresa", "dim_tarifa", "dim_pagamento", "dim_transmissao", "dim_zona", "dim_calendario"]
 fato = "ft_corrida_taxi"
 
-for tabela in dimensoes:
-    df_ = spark.read.parquet(f"{base_path}/{tabela}/")
+
+def read_refined(tabela):
+    df_ = spark.read.format(refined_format).load(f"{base_path}/{tabela}/")
+    return df_.drop("ano_corrida", "mes_corrida") if tabela == fato else df_
+
+
+def load_jdbc(tabela, df_):
+    if tabela == fato:
+        pg_execute(f"TRUNCATE {schema}.{fato}")
+        df_.write.mode("append").jdbc(jdbc_url, f"{schema}.{fato}", properties=props)
+        return
     df_.write.mode("overwrite").option("truncate", "true").option("cascadeTruncate", "true").jdbc(jdbc_url, f"{schema}.{tabela}", properties=props)
 
-df_fato = spark.read.parquet(f"{base_path}/{fato}/")
-df_fato.write.mode("overwrite").option("truncate", "true").jdbc(jdbc_url, f"{schema}.{fato}", properties=props)
+
+def load_copy(target, df_, rows):
+    copy_sql = f"COPY {target} ({', '.join(df_.columns)}) FROM STDIN WITH (FORMAT csv)"
+    conn_info = pg_conn_info
+    batch_rows = copy_batch_rows
+
+    def copy_partition(rows):
+        import csv
+        import io
+        import itertools
+        import psycopg2
+
+        first = next(rows, None)
+        if first is None:
+            return
+        rows = itertools.chain([first], rows)
+        conn = psycopg2.connect(**conn_info)
+        try:
+            with conn, conn.cursor() as cur:
+                buf, pending = io.StringIO(), 0
+                writer = csv.writer(buf)
+                for row in rows:
+                    writer.writerow(row)
+                    pending += 1
+                    if pending >= batch_rows:
+                        buf.seek(0)
+                        cur.copy_expert(copy_sql, buf)
+                        buf, pending = io.StringIO(), 0
+                        writer = csv.writer(buf)
+                if pending:
+                    buf.seek(0)
+                    cur.copy_expert(copy_sql, buf)
+        finally:
+            conn.close()
+
+    writers = min(copy_writers, rows // batch_rows + 1)
+    if df_.rdd.getNumPartitions() > writers:
+        df_ = df_.coalesce(writers)
+    else:
+        df_ = df_.repartition(writers)
+    df_.foreachPartition(copy_partition)
+
+
+def load_table(tabela):
+    started = time.perf_counter()
+    df_ = read_refined(tabela)
+    rows = df_.count()
+    if load_method == "copy":
+        load_copy(f"{schema}.{tabela}", df_, rows)
+    else:
+        load_jdbc(tabela, df_)
+    elapsed = time.perf_counter() - started
+    print(f"{tabela}: {rows} rows via {load_method} in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)")
+
+
+pg_types = {
+    "IntegerType": "integer",
+    "LongType": "bigint",
+    "FloatType": "real",
+    "DoubleType": "double precision",
+    "StringType": "text",
+    "TimestampType": "timestamp",
+    "DateType": "date",
+}
+
+
+def pg_execute(*statements):
+    conn = psycopg2.connect(**pg_conn_info)
+    try:
+        with conn, conn.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement)
+    finally:
+        conn.close()
+
+
+def pg_fetchone(sql, params=None):
+    conn = psycopg2.connect(**pg_conn_info)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute(sql, params)
+            return cur.fetchone()
+    finally:
+        conn.close()
+
+
+def relkind(tabela):
+    row = pg_fetchone(
+        "SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = %s AND c.relname = %s",
+        (schema, tabela),
+    )
+    return row[0] if row else None
+
+
+def column_ddl(df_):
+    return ", ".join(f"{field.name} {pg_types.get(type(field.dataType).__name__, 'text')}" for field in df_.schema.fields)
+
+
+def append_rows(df_, target):
+    rows = df_.count()
+    if load_method == "copy":
+        load_copy(target, df_, rows)
+    else:
+        df_.write.mode("append").jdbc(jdbc_url, target, properties=props)
+    return rows
+
+
+def month_bounds(period):
+    inicio = datetime.strptime(period, "%Y-%m").date()
+    return inicio, (inicio + timedelta(days=32)).replace(day=1)
+
+
+def ensure_partitions(periods):
+    conn = psycopg2.connect(**pg_conn_info)
+    try:
+        with conn, conn.cursor() as cur:
+            for period in periods:
+                dw_schema.ensure_month_partition(cur, schema, *month_bounds(period))
+    finally:
+        conn.close()
+
+
+def refined_periods(df_fato):
+    return sorted(f"{r['ano_corrida']:04d}-{r['mes_corrida']:02d}" for r in df_fato.select("ano_corrida", "mes_corrida").distinct().collect())
+
+
+def refresh_dimension(tabela):
+    started = time.perf_counter()
+    df_ = read_refined(tabela)
+    stg = f"{schema}.{tabela}_stg"
+    if relkind(tabela) is None:
+        pg_execute(f"CREATE TABLE {schema}.{tabela} ({column_ddl(df_)})")
+    pg_execute(f"DROP TABLE IF EXISTS {stg}", f"CREATE TABLE {stg} (LIKE {schema}.{tabela} INCLUDING DEFAULTS)")
+    rows = append_rows(df_, stg)
+    pg_execute(
+        f"DELETE FROM {schema}.{tabela}",
+        f"INSERT INTO {schema}.{tabela} SELECT * FROM {stg}",
+        f"DROP TABLE {stg}",
+    )
+    print(f"{tabela}: {rows} rows swapped in {time.perf_counter() - started:.1f}s")
+
+
+def refresh_fact_month(df_fato, period):
+    started = time.perf_counter()
+    inicio, fim = month_bounds(period)
+    nome = f"{fato}_{inicio:%Y%m}"
+    part = f"{schema}.{nome}"
+    stg = f"{part}_stg"
+    pg_execute(f"DROP TABLE IF EXISTS {stg}", f"CREATE TABLE {stg} (LIKE {schema}.{fato} INCLUDING DEFAULTS)")
+    df_mes = df_fato.where((f.col("ano_corrida") == inicio.year) & (f.col("mes_corrida") == inicio.month)).drop("ano_corrida", "mes_corrida")
+    rows = append_rows(df_mes, stg)
+    # CHECK (varredura do mês) e índices ficam fora da troca: com eles prontos o ATTACH não varre nem indexa nada,
+    # e a transação que bloqueia o fato só mexe em catálogo.
+    pg_execute(
+        f"ALTER TABLE {stg} ADD CONSTRAINT {nome}_range CHECK (ts_inicio_corrida >= '{inicio}' AND ts_inicio_corrida < '{fim}')",
+        *dw_schema.partition_indexes(stg),
+    )
+    swap = []
+    if relkind(nome) is not None:
+        swap += [f"ALTER TABLE {schema}.{fato} DETACH PARTITION {part}", f"DROP TABLE {part}"]
+    swap += [
+        f"ALTER TABLE {stg} RENAME TO {nome}",
+        f"ALTER TABLE {schema}.{fato} ATTACH PARTITION {part} FOR VALUES FROM ('{inicio}') TO ('{fim}')",
+    ]
+    pg_execute(*swap)
+    print(f"{fato} {period}: {rows} rows swapped in {time.perf_counter() - started:.1f}s")
+
+
+def load_state(name):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=f"{lake_path}/manifests/{name}.json")["Body"].read())
+    except s3.exceptions.NoSuchKey:
+        return {}
+
+
+conn = psycopg2.connect(**pg_conn_info)
+try:
+    print(f"DW migrations applied: {dw_schema.migrate(conn, schema) or 'none'}")
+finally:
+    conn.close()
+converted = relkind(f"{fato}_legacy") is not None
+df_fato = spark.read.format(refined_format).load(f"{base_path}/{fato}/")
+
+if load_mode == "incremental":
+    state = load_state("refined_to_dw")
+    refined_state = load_state("refined_zone")
+
+    if converted or not state.get("loaded_at"):
+        periods = refined_periods(df_fato)
+    else:
+        # Meses de embarque (partições do fato) que a Refined reescreveu depois da última carga.
+        periods = sorted(p for p, ts in refined_state.get("periods", {}).items() if ts > state["loaded_at"])
+    print(f"incremental DW refresh, months: {periods or 'none'}")
+
+    with ThreadPoolExecutor(max_workers=load_workers) as pool:
+        futures = [pool.submit(refresh_dimension, tabela) for tabela in dimensoes]
+        futures += [pool.submit(refresh_fact_month, df_fato, period) for period in periods]
+        for future in as_completed(futures):
+            future.result()
+
+    state["loaded_at"] = run_started_at.isoformat()
+    s3.put_object(Body=json.dumps(state, indent=2).encode("utf-8"), Bucket=bucket, Key=f"{lake_path}/manifests/refined_to_dw.json", ContentType="application/json")
+else:
+    if load_method == "copy":
+        pg_execute(f"TRUNCATE {', '.join(f'{schema}.{tabela}' for tabela in dimensoes + [fato])} CASCADE")
+
+    with ThreadPoolExecutor(max_workers=load_workers) as pool:
+        futures = {pool.submit(load_table, tabela): tabela for tabela in dimensoes}
+        for future in as_completed(futures):
+            future.result()
+
+    ensure_partitions(refined_periods(df_fato))
+    load_table(fato)
+
+if converted:
+    pg_execute(f"DROP TABLE {schema}.{fato}_legacy")
+
+started = time.perf_counter()
+conn = psycopg2.connect(**pg_conn_info)
+try:
+    dw_schema.refresh_rollups(conn, schema)
+    dw_schema.record_load(conn, schema, load_mode)
+finally:
+    conn.close()
+print(f"rollups refreshed in {time.perf_counter() - started:.1f}s")
@@ -1,11 +1,21 @@
 import os
+import re
 import sys
 import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from functools import reduce
 import boto3
 from awsglue.utils import getResolvedOptions
-from pyspark.sql import SparkSession, functions as f, Window as w
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, functions as f
+from reference_data import REFERENCE_VERSION, REFERENCES, BLANK, reference_df
+from surrogate_keys import assign_surrogate_keys
 
-args = getResolvedOptions(sys.argv, ["app_env_secret_name"])
+args = getResolvedOptions(sys.argv, ["base_path", "app_env_secret_name"])
+lake_path = args["base_path"].rstrip("/")
 secret_name = args["app_env_secret_name"]
 
 
@@ -13,6 +23,14 @@ sm = boto3.client("secretsmanager", region_name=os.environ.get("AWS_REGION", "us
 cfg = json.loads(sm.get_secret_value(SecretId=secret_name)["SecretString"])
 
 bucket = cfg["BUCKET_NAME"]
+key_map_path = f"s3a://{bucket}/{lake_path}/keymaps"
+row_group_bytes = int(cfg.get("PARQUET_ROW_GROUP_MB", 128)) * 1024 * 1024
+storage_level = getattr(StorageLevel, cfg.get("REFINED_STORAGE_LEVEL", "MEMORY_AND_DISK"))
+write_workers = int(cfg.get("REFINED_WRITE_WORKERS", 4))
+refined_format = cfg.get("REFINED_FORMAT", "parquet")
+vacuum_interval_days = int(cfg.get("REFINED_VACUUM_INTERVAL_DAYS", 7))
+vacuum_retain_hours = int(cfg.get("REFINED_VACUUM_RETAIN_HOURS", 168))
+run_started_at = datetime.utcnow()
 base_path = f"s3a://{bucket}/refined-zone"
 base_path = base_path.rstrip("/")
 if base_path.startswith("s3://"):
@@ -20,31 +38,133 @@ if base_path.startswith("s3://"):
 if not base_path.endswith("/refined-zone"):
     base_path = f"{base_path}/refined-zone"
 
-spark = SparkSession.builder.appName("TlcTripsRefined").getOrCreate()
+spark = SparkSession.builder.appName("TlcTripsRefined").config("spark.scheduler.mode", "FAIR").getOrCreate()
 spark._jsc.hadoopConfiguration().set(
     "fs.s3a.aws.credentials.provider",
     "com.amazonaws.auth.InstanceProfileCredentialsProvider,com.amazonaws.auth.DefaultAWSCredentialsProviderChain",
 )
 
+sc = spark.sparkContext
+s3 = boto3.client("s3")
+
+if refined_format == "delta":
+    from delta.tables import DeltaTable
+
+
+def load_state(name):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=f"{lake_path}/manifests/{name}.json")["Body"].read())
+    except s3.exceptions.NoSuchKey:
+        return {}
+
+
+def source_filter(months):
+    return reduce(
+        lambda acc, cond: acc | cond,
+        [(f.col("source_year") == ano) & (f.col("source_month") == mes) for ano, mes in sorted(set(months))],
+        f.lit(False),
+    )
+
+
+def period_filter(periods):
+    # As corridas de um mês de embarque estão no arquivo da TLC do mês e, nas bordas, nos dos meses vizinhos: o filtro
+    # por source_year/source_month fica como conjunção de topo para o Spark podar as partições da Trusted, e o filtro
+    # por tpep_pickup_datetime seleciona as corridas exatas.
+    fontes, corridas = [], []
+    for period in periods:
+        inicio = datetime.strptime(period, "%Y-%m")
+        fim = (inicio + timedelta(days=32)).replace(day=1)
+        anterior = (inicio - timedelta(days=1)).replace(day=1)
+        fontes += [(d.year, d.month) for d in (anterior, inicio, fim)]
+        corridas.append((f.col("tpep_pickup_datetime") >= inicio) & (f.col("tpep_pickup_datetime") < fim))
+    return source_filter(fontes) & reduce(lambda acc, cond: acc | cond, corridas, f.lit(False))
+
+
+def period_predicate(periods):
+    return " OR ".join(f"(ano_corrida = {int(p[:4])} AND mes_corrida = {int(p[5:])})" for p in periods)
+
+
+def metric_value(value):
+    # Valores das métricas SQL chegam formatados ("1,234", "1.2 GiB" ou "total (min, med, max)\n1.2 GiB (...)").
+    match = re.search(r"([\d.,]+)\s*(B|KiB|MiB|GiB|TiB)?", value.split("\n")[-1])
+    if not match:
+        return 0
+    number = float(match[1].replace(",", ""))
+    return number * 1024 ** ["B", "KiB", "MiB", "GiB", "TiB"].index(match[2]) if match[2] else number
+
+
+def report_file_scans():
+    if not sc.uiWebUrl:
+        print("Spark UI disabled, scan report skipped")
+        return
+    # Só diagnóstico: roda no finally da escrita, então uma falha aqui não pode esconder o erro real nem derrubar o job.
+    # Conta nós de leitura de arquivo dos planos SQL (os que têm "number of files read"); leituras do ft_projetado em
+    # cache (InMemoryTableScan) não entram, ao contrário do inputBytes dos stages.
+    api = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}"
+    try:
+        with urllib.request.urlopen(f"{api}/jobs", timeout=10) as resp:
+            groups = {job["jobId"]: job.get("jobGroup") or "sem_grupo" for job in json.loads(resp.read())}
+        with urllib.request.urlopen(f"{api}/sql?details=true&planDescription=false&length=100000", timeout=10) as resp:
+            executions = json.loads(resp.read())
+        scans = {}
+        for execution in executions:
+            job_ids = execution.get("successJobIds", []) + execution.get("failedJobIds", []) + execution.get("runningJobIds", [])
+            if not job_ids:
+                continue
+            group = groups.get(job_ids[0], "sem_grupo")
+            for node in execution.get("nodes", []):
+                metrics = {metric["name"]: metric["value"] for metric in node.get("metrics", [])}
+                if "number of files read" not in metrics:
+                    continue
+                count, files, read_bytes = scans.get(group, (0, 0, 0))
+                scans[group] = (
+                    count + 1,
+                    files + int(metric_value(metrics["number of files read"])),
+                    read_bytes + metric_value(metrics.get("size of files read", "0")),
+                )
+    except Exception as e:
+        print(f"scan report skipped: {e}")
+        return
+    for group, (count, files, read_bytes) in scans.items():
+        print(f"scan report {group}: {count} file scans, {files} files, {read_bytes / 1024 / 1024:.1f} MB")
+
+
 df = spark.read.parquet(f"s3a://{bucket}/trusted-zone/yellow_tripdata")
+
+trusted_state = load_state("trusted_zone")
+refined_state = load_state("refined_zone")
+fact_path = f"{base_path}/ft_corrida_taxi/"
+changed_periods = None
+if refined_format == "delta" and refined_state.get("processed_at") and DeltaTable.isDeltaTable(spark, fact_path):
+    # A Trusted marca meses de arquivo (source_year/source_month); o fato é particionado por mês de embarque. Refaz os
+    # meses de embarque que aparecem nas partições da Trusted alteradas desde a última execução.
+    changed_sources = sorted(p for p, ts in trusted_state.get("periods", {}).items() if ts > refined_state["processed_at"])
+    changed_periods = []
+    if changed_sources:
+        sc.setJobGroup("periodos", "Meses de embarque nas partições alteradas da Trusted")
+        changed_periods = sorted(
+            row[0]
+            for row in df.where(source_filter((int(p[:4]), int(p[5:])) for p in changed_sources))
+            .select(f.date_format("tpep_pickup_datetime", "yyyy-MM")).distinct().collect()
+            if row[0]
+        )
+    print(f"incremental refined run, changed source months: {changed_sources or 'none'}, pickup months: {changed_periods or 'none'}")
+    df = df.where(period_filter(changed_periods))
+sc.setJobGroup("dimensoes", "Dimensões e mapas de chaves")
 df_taxi_zone = spark.read.parquet(f"s3a://{bucket}/trusted-zone/taxi_zone")
 
-ft_corrida_taxi = df.select(
+ft_projetado = df.select(
     f.col("VendorID").alias("cd_empresa"),
-    f.col("VendorDesc").alias("ds_empresa"),
     f.col("passenger_count").alias("qt_passageiros"),
     f.col("total_amount").alias("vl_total"),
     f.col("tpep_pickup_datetime").alias("ts_inicio_corrida"),
     f.col("tpep_dropoff_datetime").alias("ts_fim_corrida"),
     f.col("trip_distance").alias("vl_distancia_mi"),
     f.col("RatecodeID").alias("cd_tarifa"),
-    f.col("RatecodeDesc").alias("ds_tarifa"),
     f.col("store_and_fwd_flag").alias("fl_transmissao"),
-    f.col("store_and_fwd_desc").alias("ds_transmissao"),
     f.col("PULocationID").alias("cd_zona_embarque"),
     f.col("DOLocationID").alias("cd_zona_desembarque"),
     f.col("payment_type").alias("cd_pagamento"),
-    f.col("payment_desc").alias("ds_pagamento"),
     f.col("fare_amount").alias("vl_tarifa_base"),
     f.col("extra").alias("vl_extra"),
     f.col("mta_tax").alias("vl_mta_tax"),
@@ -53,33 +173,71 @@ ft_corrida_taxi = df.select(
     f.col("improvement_surcharge").alias("vl_sobretaxa_melhoria"),
     f.col("congestion_surcharge").alias("vl_sobretaxa_congestionamento"),
     f.col("airport_fee").alias("vl_taxa_aeroporto"),
+).persist(storage_level)
+
+print(f"reference data version {REFERENCE_VERSION}")
+
+
+fato_valido = (
+    (f.col("vl_total") >= 0) &
+    (f.col("ts_inicio_corrida") >= '2023-01-01') &
+    (f.col("ts_inicio_corrida") <= '2023-05-31') &
+    (f.col("qt_passageiros") >= 0) &
+    (f.col("vl_distancia_mi") >= 0)
 )
 
+sc.setJobGroup("materializa_fato", "Materialização do fato e limites do calendário")
+limites_fato = ft_projetado.agg(
+    f.count("*").alias("qt_linhas"),
+    f.year(f.min("ts_inicio_corrida")).alias("ano_inicio"),
+    f.year(f.max("ts_fim_corrida")).alias("ano_fim"),
+    f.collect_set(f.when(fato_valido, f.date_format("ts_inicio_corrida", "yyyy-MM"))).alias("periodos"),
+    *[f.collect_set(code_col).alias(code_col) for code_col, _, _, _ in REFERENCES.values()],
+).first()
+print(f"ft_projetado materialized ({storage_level}): {limites_fato['qt_linhas']} rows")
+if limites_fato["ano_inicio"] is None:
+    if changed_periods is None:
+        raise RuntimeError("trusted-zone/yellow_tripdata está vazio")
+    limites = spark.createDataFrame([], "dt_inicio date, dt_fim date")
+else:
+    limites = spark.createDataFrame(
+        [(date(limites_fato["ano_inicio"], 1, 1), date(limites_fato["ano_fim"], 12, 31))],
+        "dt_inicio date, dt_fim date",
+    )
+
+sc.setJobGroup("dimensoes", "Dimensões e mapas de chaves")
+
+
+def dimension_rows(name):
+    # Registro versionado + códigos do fato que ainda não estão nele (ex.: VendorID novo), com descrição "Blank"
+    # como a Trusted já grava, para que toda linha do fato encontre sua dimensão. Os códigos do fato vêm da agregação
+    # única sobre ft_projetado; a comparação com o registro é feita no driver.
+    code_col, _, _, labels = REFERENCES[name]
+    ref = reference_df(spark, name, include_blank=True)
+    unknown = [code for code in limites_fato[code_col] if code not in labels]
+    if not unknown:
+        return ref
+    print(f"dim {name}: codes missing from reference data {REFERENCE_VERSION}: {sorted(unknown)}")
+    return ref.unionByName(spark.createDataFrame([(code, BLANK) for code in unknown], ref.schema))
+
+
 dim_empresa = (
-    ft_corrida_taxi.select("cd_empresa", "ds_empresa").dropDuplicates()
-    .orderBy("cd_empresa")
-    .withColumn("sk_empresa", f.row_number().over(w.orderBy("cd_empresa")))
+    assign_surrogate_keys(spark, dimension_rows("empresa"), ["cd_empresa"], "sk_empresa", f"{key_map_path}/dim_empresa")
     .select("sk_empresa", "cd_empresa", "ds_empresa")
 )
 
 dim_tarifa = (
-    ft_corrida_taxi.select("cd_tarifa", "ds_tarifa").dropDuplicates()
-    .orderBy("cd_tarifa")
-    .withColumn("sk_tarifa", f.row_number().over(w.orderBy("cd_tarifa")))
+    assign_surrogate_keys(spark, dimension_rows("tarifa"), ["cd_tarifa"], "sk_tarifa", f"{key_map_path}/dim_tarifa")
     .select("sk_tarifa", "cd_tarifa", "ds_tarifa")
 )
 
 dim_pagamento = (
-    ft_corrida_taxi.select("cd_pagamento", "ds_pagamento").dropDuplicates()
-    .orderBy("cd_pagamento")
-    .withColumn("sk_pagamento", f.row_number().over(w.orderBy("cd_pagamento")))
+    assign_surrogate_keys(spark, dimension_rows("pagamento"), ["cd_pagamento"], "sk_pagamento", f"{key_map_path}/dim_pagamento")
     .select("sk_pagamento", "cd_pagamento", "ds_pagamento")
 )
 
 dim_transmissao = (
-    ft_corrida_taxi.select("fl_transmissao", "ds_transmissao").dropDuplicates()
-    .orderBy("fl_transmissao", "ds_transmissao")
-    .withColumn("sk_transmissao", f.row_number().over(w.orderBy("fl_transmissao", "ds_transmissao")))
+    assign_surrogate_keys(spark, dimension_rows("transmissao"), ["fl_transmissao"], "sk_transmissao", f"{key_map_path}/dim_transmissao")
     .select("sk_transmissao", "fl_transmissao", "ds_transmissao")
 )
 
@@ -91,19 +249,10 @@ dim_zona = (
         f.col("service_zone").alias("ds_zona_servico"),
     )
     .dropDuplicates(["cd_zona"])
-    .orderBy("cd_zona")
-    .withColumn("sk_zona", f.row_number().over(w.orderBy("cd_zona")))
-    .select("sk_zona", "cd_zona", "ds_zona", "ds_distrito", "ds_zona_servico")
-)
-
-anos = ft_corrida_taxi.agg(
-    f.year(f.min("ts_inicio_corrida")).alias("ano_inicio"),
-    f.year(f.max("ts_fim_corrida")).alias("ano_fim"),
 )
-
-limites = anos.select(
-    f.to_date(f.concat_ws("-", f.col("ano_inicio"), f.lit("01"), f.lit("01"))).alias("dt_inicio"),
-    f.to_date(f.concat_ws("-", f.col("ano_fim"), f.lit("12"), f.lit("31"))).alias("dt_fim"),
+dim_zona = (
+    assign_surrogate_keys(spark, dim_zona, ["cd_zona"], "sk_zona", f"{key_map_path}/dim_zona")
+    .select("sk_zona", "cd_zona", "ds_zona", "ds_distrito", "ds_zona_servico")
 )
 
 dim_calendario = (
@@ -117,7 +266,7 @@ dim_calendario = (
     .select("dt_calendario", "ano", "mes", "dia", "trimestre", "ano_mes")
 )
 
-ft_corrida_taxi = ft_corrida_taxi.select(
+ft_corrida_taxi = ft_projetado.select(
     f.col("cd_empresa"),
     f.col("qt_passageiros"),
     f.col("vl_total"),
@@ -137,13 +286,9 @@ ft_corrida_taxi = ft_corrida_taxi.select(
     f.col("vl_sobretaxa_melhoria"),
     f.col("vl_sobretaxa_congestionamento"),
     f.col("vl_taxa_aeroporto"),
-).where(
-    (f.col("vl_total") >= 0) &
-    (f.col("ts_inicio_corrida") >= '2023-01-01') &
-    (f.col("ts_inicio_corrida") <= '2023-05-31') &
-    (f.col("qt_passageiros") >= 0) &
-    (f.col("vl_distancia_mi") >= 0)
-)
+    f.year("ts_inicio_corrida").alias("ano_corrida"),
+    f.month("ts_inicio_corrida").alias("mes_corrida"),
+).where(fato_valido).repartition("ano_corrida", "mes_corrida").sortWithinPartitions("ts_inicio_corrida", "cd_zona_embarque")
 
 datasets = {
     "dim_empresa": dim_empresa,
@@ -155,6 +300,95 @@ datasets = {
     "ft_corrida_taxi": ft_corrida_taxi,
 }
 
-for nome, ddf in datasets.items():
-    ddf.write.format("parquet").mode("overwrite").option("compression", "snappy").save(f"{base_path}/{nome}/")
-    print(f"{nome} saved")
+if changed_periods == []:
+    del datasets["ft_corrida_taxi"], datasets["dim_calendario"]
+
+partition_cols = {
+    "ft_corrida_taxi": ["ano_corrida", "mes_corrida"],
+}
+
+merge_keys = {
+    "dim_empresa": ["cd_empresa"],
+    "dim_tarifa": ["cd_tarifa"],
+    "dim_pagamento": ["cd_pagamento"],
+    "dim_transmissao": ["fl_transmissao"],
+    "dim_zona": ["cd_zona"],
+    "dim_calendario": ["dt_calendario"],
+}
+
+
+def merge_dimension(nome, ddf, path):
+    keys = merge_keys[nome]
+    on = " AND ".join(f"t.{c} <=> s.{c}" for c in keys)
+    changed = " OR ".join(f"NOT (t.{c} <=> s.{c})" for c in ddf.columns if c not in keys)
+    (
+        DeltaTable.forPath(spark, path).alias("t")
+        .merge(ddf.alias("s"), on)
+        .whenMatchedUpdateAll(condition=changed or None)
+        .whenNotMatchedInsertAll()
+        .execute()
+    )
+
+
+def maintain_delta(paths):
+    fact = DeltaTable.forPath(spark, fact_path)
+    if changed_periods:
+        fact.optimize().where(period_predicate(changed_periods)).executeCompaction()
+    elif changed_periods is None:
+        fact.optimize().executeCompaction()
+    last_vacuum = refined_state.get("last_vacuum_at")
+    if last_vacuum and datetime.fromisoformat(last_vacuum) > run_started_at - timedelta(days=vacuum_interval_days):
+        return last_vacuum
+    for path in paths:
+        DeltaTable.forPath(spark, path).vacuum(vacuum_retain_hours)
+    print(f"vacuum done, keeping {vacuum_retain_hours}h of history")
+    return run_started_at.isoformat()
+
+
+def write_dataset(nome, ddf):
+    started = time.perf_counter()
+    sc.setLocalProperty("spark.scheduler.pool", "fato" if nome.startswith("ft_") else "dimensoes")
+    sc.setJobGroup(f"write:{nome}", f"Escrita de {nome}")
+    path = f"{base_path}/{nome}/"
+    if refined_format == "delta" and nome in merge_keys and DeltaTable.isDeltaTable(spark, path):
+        merge_dimension(nome, ddf, path)
+        return time.perf_counter() - started
+    writer = ddf.write.format(refined_format).mode("overwrite").option("compression", "snappy").option("parquet.block.size", row_group_bytes)
+    if nome in partition_cols:
+        writer = writer.partitionBy(*partition_cols[nome])
+    if nome == "ft_corrida_taxi" and changed_periods:
+        writer = writer.option("replaceWhere", period_predicate(changed_periods))
+    writer.save(path)
+    return time.perf_counter() - started
+
+
+failed = []
+try:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=write_workers) as pool:
+        ordered = sorted(datasets.items(), key=lambda item: not item[0].startswith("ft_"))
+        futures = {pool.submit(write_dataset, nome, ddf): nome for nome, ddf in ordered}
+        for future in as_completed(futures):
+            nome = futures[future]
+            try:
+                print(f"{nome} saved in {future.result():.1f}s")
+            except Exception as e:
+                failed.append(nome)
+                print(f"{nome} failed: {e}")
+    print(f"{len(datasets)} datasets with {write_workers} writers in {time.perf_counter() - started:.1f}s")
+finally:
+    ft_projetado.unpersist()
+    report_file_scans()
+
+if failed:
+    raise RuntimeError(f"Refined write failed for: {', '.join(sorted(failed))}")
+
+if refined_format == "delta":
+    refined_state["last_vacuum_at"] = maintain_delta([f"{base_path}/{nome}/" for nome in merge_keys] + [fact_path])
+# Meses de embarque reescritos nesta execução, com o horário do fim da escrita: é o que o refined_to_dw incremental
+# recarrega (uma carga do DW que começou antes deste ponto leu a versão anterior e pega estes meses na próxima).
+rewritten = changed_periods if changed_periods is not None else sorted(limites_fato["periodos"])
+finished_at = datetime.utcnow().isoformat()
+refined_state.setdefault("periods", {}).update({period: finished_at for period in rewritten})
+refined_state["processed_at"] = run_started_at.isoformat()
+s3.put_object(Body=json.dumps(refined_state, indent=2).encode("utf-8"), Bucket=bucket, Key=f"{lake_path}/manifests/refined_zone.json", ContentType="application/json")
@@ -0,0 +1,42 @@
+from functools import reduce
+from pyspark.sql import functions as f, types as t
+from pyspark.sql.utils import AnalysisException
+
+
+def _load_key_map(spark, key_map_path):
+    try:
+        return spark.read.parquet(key_map_path)
+    except AnalysisException:
+        return None
+
+
+def _match(left, right, business_keys):
+    return reduce(lambda acc, cond: acc & cond, [left[c].eqNullSafe(right[c]) for c in business_keys])
+
+
+def assign_surrogate_keys(spark, dim_df, business_keys, sk_col, key_map_path):
+    keys = dim_df.select(*business_keys).distinct()
+    key_map = _load_key_map(spark, key_map_path)
+
+    if key_map is None:
+        max_sk = 0
+        unseen = keys
+    else:
+        max_sk = key_map.agg(f.max(sk_col)).first()[0] or 0
+        unseen = keys.join(key_map, _match(keys, key_map, business_keys), "left_anti")
+
+    schema = t.StructType([keys.schema[c] for c in business_keys] + [t.StructField(sk_col, t.IntegerType(), False)])
+    new_keys = (
+        unseen.orderBy(*business_keys).rdd
+        .zipWithIndex()
+        .map(lambda pair: (*pair[0], int(pair[1] + max_sk + 1)))
+        .toDF(schema)
+        .localCheckpoint()
+    )
+    new_count = new_keys.count()
+    if new_count:
+        new_keys.write.mode("append").parquet(key_map_path)
+    print(f"{key_map_path}: {new_count} new keys after sk {max_sk}")
+
+    key_map = new_keys if key_map is None else key_map.unionByName(new_keys)
+    return dim_df.join(key_map, _match(dim_df, key_map, business_keys), "left").select(dim_df["*"], key_map[sk_col])
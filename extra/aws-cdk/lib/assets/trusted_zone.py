@@ -1,10 +1,12 @@
 import os
+import re
 import sys
 import json
 from datetime import datetime
 import boto3
 from awsglue.utils import getResolvedOptions
 from pyspark.sql import SparkSession, functions as f
+from reference_data import REFERENCE_VERSION, REFERENCES, BLANK, reference_df
 
 args = getResolvedOptions(sys.argv, ["base_path", "app_env_secret_name"])
 base_path = args["base_path"].rstrip("/")
@@ -13,92 +15,147 @@ secret_name = args["app_env_secret_name"]
 sm = boto3.client("secretsmanager", region_name=os.environ.get("AWS_REGION", "us-east-1"))
 cfg = json.loads(sm.get_secret_value(SecretId=secret_name)["SecretString"])
 bucket_name = cfg["BUCKET_NAME"]
+incremental = str(cfg.get("TRUSTED_INCREMENTAL", "false")).lower() == "true"
+row_group_bytes = int(cfg.get("PARQUET_ROW_GROUP_MB", 128)) * 1024 * 1024
 
 spark = SparkSession.builder.appName("TlcTripsTrusted").getOrCreate()
 spark._jsc.hadoopConfiguration().set(
     "fs.s3a.aws.credentials.provider",
     "com.amazonaws.auth.InstanceProfileCredentialsProvider,com.amazonaws.auth.DefaultAWSCredentialsProviderChain",
 )
+spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
 
 ingest_dt = datetime.utcnow()
-y = f"{ingest_dt.year:04d}"
-m = f"{ingest_dt.month:02d}"
-d = f"{ingest_dt.day:02d}"
+today = f"{ingest_dt.year:04d}-{ingest_dt.month:02d}-{ingest_dt.day:02d}"
 
-df_raw = spark.read.parquet(
-    f"s3a://{bucket_name}/{base_path}/landing-zone/yellow_tripdata/year={y}/month={m}/day={d}/"
-)
+s3 = boto3.client("s3")
+watermark_key = f"{base_path}/manifests/trusted_zone.json"
+partition_pattern = re.compile(r"year=(\d{4})/month=(\d{2})/day=(\d{2})/([^/]+)$")
 
-df = df_raw.select(
-    f.col("VendorID").cast("integer").alias("VendorID"),
-    f.col("passenger_count").cast("integer").alias("passenger_count"),
-    f.col("total_amount").cast("float").alias("total_amount"),
-    f.col("tpep_pickup_datetime").cast("timestamp").alias("tpep_pickup_datetime"),
-    f.col("tpep_dropoff_datetime").cast("timestamp").alias("tpep_dropoff_datetime"),
-    f.col("trip_distance").cast("float").alias("trip_distance"),
-    f.col("store_and_fwd_flag").cast("string").alias("store_and_fwd_flag"),
-    f.col("RatecodeID").cast("integer").alias("RatecodeID"),
-    f.col("PULocationID").cast("integer").alias("PULocationID"),
-    f.col("DOLocationID").cast("integer").alias("DOLocationID"),
-    f.col("payment_type").cast("integer").alias("payment_type"),
-    f.col("fare_amount").cast("float").alias("fare_amount"),
-    f.col("extra").cast("float").alias("extra"),
-    f.col("mta_tax").cast("float").alias("mta_tax"),
-    f.col("tip_amount").cast("float").alias("tip_amount"),
-    f.col("tolls_amount").cast("float").alias("tolls_amount"),
-    f.col("improvement_surcharge").cast("float").alias("improvement_surcharge"),
-    f.col("congestion_surcharge").cast("float").alias("congestion_surcharge"),
-    f.col("airport_fee").cast("float").alias("airport_fee"),
-)
 
-df = df.select(
-    "*",
-    f.expr("""
-        CASE
-            WHEN VendorID = 1 THEN 'Creative Mobile Technologies, LLC'
-            WHEN VendorID = 2 THEN 'Curb Mobility, LLC'
-            WHEN VendorID = 6 THEN 'Myle Technologies Inc'
-            WHEN VendorID = 7 THEN 'Helix'
-            ELSE 'Blank'
-        END
-    """).alias("VendorDesc"),
-    f.expr("""
-        CASE
-            WHEN RatecodeID = 1 THEN 'Standard rate'
-            WHEN RatecodeID = 2 THEN 'JFK'
-            WHEN RatecodeID = 3 THEN 'Newark'
-            WHEN RatecodeID = 4 THEN 'Nassau or Westchester'
-            WHEN RatecodeID = 5 THEN 'Negotiated fare'
-            WHEN RatecodeID = 6 THEN 'Group ride'
-            WHEN RatecodeID = 99 THEN 'Null/unknown'
-            ELSE 'Blank'
-        END
-    """).alias("RatecodeDesc"),
-    f.when(f.col("store_and_fwd_flag") == "Y", "Store and forward trip")
-     .when(f.col("store_and_fwd_flag") == "N", "Not a store and forward trip")
-     .otherwise("Blank")
-     .alias("store_and_fwd_desc"),
-    f.expr("""
-        CASE
-            WHEN payment_type = 0 THEN 'Flex Fare trip'
-            WHEN payment_type = 1 THEN 'Credit card'
-            WHEN payment_type = 2 THEN 'Cash'
-            WHEN payment_type = 3 THEN 'No charge'
-            WHEN payment_type = 4 THEN 'Dispute'
-            WHEN payment_type = 5 THEN 'Unknown'
-            WHEN payment_type = 6 THEN 'Voided trip'
-            ELSE 'Blank'
-        END
-    """).alias("payment_desc"),
-)
+def load_watermark():
+    try:
+        return json.loads(s3.get_object(Bucket=bucket_name, Key=watermark_key)["Body"].read())
+    except s3.exceptions.NoSuchKey:
+        return {}
 
-df.write.mode("overwrite").option("compression", "snappy").parquet(f"s3a://{bucket_name}/trusted-zone/yellow_tripdata/")
 
-df_taxi_zone_raw = spark.read.csv(f"s3a://{bucket_name}/landing-zone/taxi_zone/", header=True, inferSchema=False)
-df_taxi_zone = df_taxi_zone_raw.select(
-    f.col("LocationID").cast("integer").alias("LocationID"),
-    f.col("Borough").cast("string").alias("Borough"),
-    f.col("Zone").cast("string").alias("Zone"),
-    f.col("service_zone").cast("string").alias("service_zone"),
-)
-df_taxi_zone.write.mode("overwrite").option("compression", "snappy").parquet(f"s3a://{bucket_name}/trusted-zone/taxi_zone/")
+def pending_files(dataset, watermark):
+    # Objetos da Landing já processados ficam no manifesto por chave + ETag (não por data): um arquivo que chega
+    # numa partição day=D depois da execução que processou D, ou que é regravado, continua pendente.
+    processed = dict(watermark.get("processed", {}).get(dataset, {}))
+    latest = {}
+    seen = {}
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{base_path}/landing-zone/{dataset}/"):
+        for item in page.get("Contents", []):
+            match = partition_pattern.search(item["Key"])
+            if not match:
+                continue
+            ingest_date = f"{match[1]}-{match[2]}-{match[3]}"
+            etag = item["ETag"].strip('"')
+            if incremental:
+                if processed.get(item["Key"]) == etag:
+                    continue
+            elif ingest_date != today:
+                continue
+            seen[item["Key"]] = etag
+            file_name = match[4]
+            if file_name not in latest or ingest_date > latest[file_name][0]:
+                latest[file_name] = (ingest_date, item["Key"])
+    paths = [f"s3a://{bucket_name}/{key}" for _, key in latest.values()]
+    # Versões antigas do mesmo arquivo também são marcadas, para não voltarem na próxima execução.
+    processed.update(seen)
+    return paths, processed
+
+
+watermark = load_watermark()
+
+trusted_schema = [
+    ("VendorID", "int"),
+    ("passenger_count", "int"),
+    ("total_amount", "float"),
+    ("tpep_pickup_datetime", "timestamp"),
+    ("tpep_dropoff_datetime", "timestamp"),
+    ("trip_distance", "float"),
+    ("store_and_fwd_flag", "string"),
+    ("RatecodeID", "int"),
+    ("PULocationID", "int"),
+    ("DOLocationID", "int"),
+    ("payment_type", "int"),
+    ("fare_amount", "float"),
+    ("extra", "float"),
+    ("mta_tax", "float"),
+    ("tip_amount", "float"),
+    ("tolls_amount", "float"),
+    ("improvement_surcharge", "float"),
+    ("congestion_surcharge", "float"),
+    ("airport_fee", "float"),
+]
+
+
+def with_description(df, name, key, alias):
+    code_col, desc_col, _, _ = REFERENCES[name]
+    ref = f.broadcast(reference_df(spark, name))
+    return df.join(ref, df[key] == ref[code_col], "left").select(df["*"], f.coalesce(ref[desc_col], f.lit(BLANK)).alias(alias))
+
+
+def transform_trips(df_raw):
+    # Com a Landing em passthrough/stream o ganho é não converter texto em número; os numéricos da TLC chegam como
+    # bigint/double e ainda passam por um cast (barato) para os int/float da Trusted. Só timestamps e a flag vão sem cast.
+    raw_types = {name.lower(): dtype for name, dtype in df_raw.dtypes}
+    casts = [f"{name} {raw_types.get(name.lower())}->{dtype}" for name, dtype in trusted_schema if raw_types.get(name.lower()) != dtype]
+    print(f"yellow_tripdata: {len(casts)} of {len(trusted_schema)} columns cast ({', '.join(casts) or 'none'})")
+    source_file = f.input_file_name()
+    df = df_raw.select(
+        *[
+            f.col(name).alias(name) if raw_types.get(name.lower()) == dtype else f.col(name).cast(dtype).alias(name)
+            for name, dtype in trusted_schema
+        ],
+        f.regexp_extract(source_file, r"yellow_tripdata_(\d{4})-(\d{2})", 1).cast("int").alias("source_year"),
+        f.regexp_extract(source_file, r"yellow_tripdata_(\d{4})-(\d{2})", 2).cast("int").alias("source_month"),
+    )
+
+    df = with_description(df, "empresa", "VendorID", "VendorDesc")
+    df = with_description(df, "tarifa", "RatecodeID", "RatecodeDesc")
+    df = with_description(df, "transmissao", "store_and_fwd_flag", "store_and_fwd_desc")
+    return with_description(df, "pagamento", "payment_type", "payment_desc")
+
+
+print(f"reference data version {REFERENCE_VERSION}")
+trip_paths, trip_processed = pending_files("yellow_tripdata", watermark)
+if trip_paths:
+    df = (
+        transform_trips(spark.read.parquet(*trip_paths))
+        .repartition("source_year", "source_month")
+        .sortWithinPartitions("tpep_pickup_datetime", "PULocationID")
+    )
+    (
+        df.write.mode("overwrite")
+        .partitionBy("source_year", "source_month")
+        .option("compression", "snappy")
+        .option("parquet.block.size", row_group_bytes)
+        .parquet(f"s3a://{bucket_name}/trusted-zone/yellow_tripdata/")
+    )
+    print(f"yellow_tripdata: {len(trip_paths)} landed files processed")
+    periods = {"-".join(re.search(r"yellow_tripdata_(\d{4})-(\d{2})", path).groups()) for path in trip_paths}
+    watermark.setdefault("periods", {}).update({period: ingest_dt.isoformat() for period in periods})
+else:
+    print("yellow_tripdata: no new landing partitions")
+
+zone_paths, zone_processed = pending_files("taxi_zone", watermark)
+if zone_paths:
+    df_taxi_zone_raw = spark.read.csv(zone_paths, header=True, inferSchema=False)
+    df_taxi_zone = df_taxi_zone_raw.select(
+        f.col("LocationID").cast("integer").alias("LocationID"),
+        f.col("Borough").cast("string").alias("Borough"),
+        f.col("Zone").cast("string").alias("Zone"),
+        f.col("service_zone").cast("string").alias("service_zone"),
+    )
+    df_taxi_zone.write.mode("overwrite").option("compression", "snappy").parquet(f"s3a://{bucket_name}/trusted-zone/taxi_zone/")
+    print(f"taxi_zone: {len(zone_paths)} landed files processed")
+else:
+    print("taxi_zone: no new landing partitions")
+
+watermark.setdefault("processed", {}).update({"yellow_tripdata": trip_processed, "taxi_zone": zone_processed})
+s3.put_object(Body=json.dumps(watermark, indent=2).encode("utf-8"), Bucket=bucket_name, Key=watermark_key, ContentType="application/json")
@@ -16,4 +16,8 @@ class GlueCrawlers(Stack):
             db = spec["database_name"]
             path = spec["s3_path"]
             cid = "".join(ch for ch in key.title() if ch.isalnum()) + "Crawler"
-            self.crawlers[key] = glue.CfnCrawler(self, cid, name=name, role=role_arn, database_name=db, targets={"s3Targets":[{"path":path}]})
+            if spec.get("delta_tables"):
+                targets = {"deltaTargets":[{"deltaTables":spec["delta_tables"], "writeManifest":False, "createNativeDeltaTable":True}]}
+            else:
+                targets = {"s3Targets":[{"path":path}]}
+            self.crawlers[key] = glue.CfnCrawler(self, cid, name=name, role=role_arn, database_name=db, targets=targets)
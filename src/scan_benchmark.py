@@ -0,0 +1,48 @@
+import sys
+import time
+from pyspark.sql import SparkSession, functions as f
+
+# Uso: spark-submit scan_benchmark.py <caminho_antes> <caminho_depois> [ano] [mes] [repeticoes]
+# Compara o tempo de uma consulta de um mês sobre o ft_corrida_taxi sem partições
+# (layout antigo) e particionado por ano_corrida/mes_corrida e ordenado por ts_inicio_corrida.
+
+path_before, path_after = sys.argv[1], sys.argv[2]
+ano = int(sys.argv[3]) if len(sys.argv) > 3 else 2023
+mes = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+repeticoes = int(sys.argv[5]) if len(sys.argv) > 5 else 3
+
+spark = SparkSession.builder.appName("TlcTripsScanBenchmark").getOrCreate()
+spark._jsc.hadoopConfiguration().set(
+    "fs.s3a.aws.credentials.provider",
+    "com.amazonaws.auth.InstanceProfileCredentialsProvider,com.amazonaws.auth.DefaultAWSCredentialsProviderChain",
+)
+
+inicio = f"{ano:04d}-{mes:02d}-01"
+fim = f"{ano + mes // 12:04d}-{mes % 12 + 1:02d}-01"
+
+
+def consulta(path, particionado):
+    df = spark.read.parquet(path)
+    if particionado:
+        df = df.where((f.col("ano_corrida") == ano) & (f.col("mes_corrida") == mes))
+    return df.where((f.col("ts_inicio_corrida") >= inicio) & (f.col("ts_inicio_corrida") < fim)).agg(
+        f.count("*").alias("qt_corridas"),
+        f.avg("vl_total").alias("vl_total_medio"),
+    )
+
+
+def medir(nome, path, particionado):
+    tempos = []
+    for _ in range(repeticoes):
+        spark.catalog.clearCache()
+        started = time.perf_counter()
+        resultado = consulta(path, particionado).collect()[0]
+        tempos.append(time.perf_counter() - started)
+    scan = [linha.strip() for linha in consulta(path, particionado)._jdf.queryExecution().executedPlan().toString().split("\n") if "FileScan" in linha]
+    print(f"{nome}: melhor {min(tempos):.2f}s, média {sum(tempos) / len(tempos):.2f}s, {resultado['qt_corridas']} corridas")
+    for linha in scan:
+        print(f"  {linha}")
+
+
+medir("antes (sem partições)", path_before, False)
+medir("depois (particionado e ordenado)", path_after, True)